@@ -1,15 +1,20 @@
 import os
 import glob
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 
-from bertalign import Bertalign
+from bertalign.workers import run_in_workers
 
 # Define input and output directories
 chinese_folder = './data_ingestion_chinese/'
 vietnamese_folder = './data_ingestion_vn/'
 output_folder = './aligned_output/'
 
+# Address of a running `python -m bertalign.service`, which keeps the model
+# loaded between runs. Unset to align in this process.
+service_url = os.environ.get('BERTALIGN_SERVICE')
+
 # Ensure the output folder exists
 os.makedirs(output_folder, exist_ok=True)
 
@@ -19,58 +24,128 @@ def align_files(chinese_file, vietnamese_file, output_file):
     and save the results to an output file with one Chinese sentence per row.
     """
     try:
-        # Read source and target texts
-        with open(chinese_file, 'r', encoding='utf-8') as f_src:
-            src = f_src.read()
-        
-        with open(vietnamese_file, 'r', encoding='utf-8') as f_tgt:
-            tgt = f_tgt.read()
+        src, tgt = read_texts(chinese_file, vietnamese_file)
         
         # Create Bertalign object and align sentences
         print(f"Aligning {os.path.basename(chinese_file)} with {os.path.basename(vietnamese_file)}...")
-        aligner = Bertalign(src, tgt)
-        alignments = aligner.align_sents()
-        
-        # Save aligned sentences to output file
-        with open(output_file, 'w', encoding='utf-8') as f_out:
-            for bead in alignments:
-                src_line = get_line(bead[0], aligner.src_sents)
-                tgt_line = get_line(bead[1], aligner.tgt_sents)
-                
-                if src_line and tgt_line:
-                    # Clean up any newlines within the aligned text to ensure one pair per line
-                    src_line = src_line.replace('\n', ' ').strip()
-                    tgt_line = tgt_line.replace('\n', ' ').strip()
-                    f_out.write(f"{src_line}\t{tgt_line}\n")
+        if service_url:
+            from bertalign.client import align_remote
+            aligner = align_remote(src, tgt, url=service_url)
+        else:
+            # Bertalign is only imported where a volume is aligned in this
+            # process, so that runs against the service do not load torch,
+            # faiss or numba.
+            from bertalign import Bertalign
+            aligner = Bertalign(src, tgt)
+            aligner.align_sents()
         
-        print(f"Alignment saved to {output_file}")
+        save_alignment(aligner, output_file)
         return True
     
     except Exception as e:
         print(f"Error aligning {chinese_file} and {vietnamese_file}: {e}")
         return False
 
-def get_line(bead, lines):
+def align_many_files(jobs, threads=1):
+    """
+    Align many (chinese_file, vietnamese_file, output_file) jobs with
+    Bertalign.align_many(), which encodes the sentences and the overlap
+    windows of groups of volumes in shared batches and aligns the volumes
+    of a group `threads` at a time. Each volume is saved as soon as its
+    group is aligned, and a volume that fails only costs itself.
+    Returns a list with True for each job that was aligned.
+    """
+    if service_url:
+        # The service batches the encoding of concurrent jobs itself.
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(lambda job: align_files(*job), jobs))
+    from bertalign import Bertalign
+    pairs = [read_texts(chinese_file, vietnamese_file) for chinese_file, vietnamese_file, _ in jobs]
+    results = []
+    for aligner, (chinese_file, vietnamese_file, output_file) in zip(Bertalign.align_many(pairs, threads=threads), jobs):
+        if aligner is None:
+            print(f"Error aligning {chinese_file} and {vietnamese_file}")
+        else:
+            save_alignment(aligner, output_file)
+        results.append(aligner is not None)
+    return results
+
+def job_sizes(jobs):
+    """Size in bytes of the texts of each job."""
+    return [os.path.getsize(chinese_file) + os.path.getsize(vietnamese_file)
+            for chinese_file, vietnamese_file, _ in jobs]
+
+def read_texts(chinese_file, vietnamese_file):
+    """Read the source and target texts of a volume."""
+    with open(chinese_file, 'r', encoding='utf-8') as f_src:
+        src = f_src.read()
+    
+    with open(vietnamese_file, 'r', encoding='utf-8') as f_tgt:
+        tgt = f_tgt.read()
+    return src, tgt
+
+def save_alignment(aligner, output_file):
+    """Save the aligned sentences of an aligner, one pair per line."""
+    with open(output_file, 'w', encoding='utf-8') as f_out:
+        for src_start, src_end, tgt_start, tgt_end in aligner.result.beads:
+            src_line = get_line(src_start, src_end, aligner.src_sents)
+            tgt_line = get_line(tgt_start, tgt_end, aligner.tgt_sents)
+            
+            if src_line and tgt_line:
+                # Clean up any newlines within the aligned text to ensure one pair per line
+                src_line = src_line.replace('\n', ' ').strip()
+                tgt_line = tgt_line.replace('\n', ' ').strip()
+                f_out.write(f"{src_line}\t{tgt_line}\n")
+    
+    print(f"Alignment saved to {output_file}")
+
+def get_line(start, end, lines):
+    """
+    Get a line of text from one side of a bead,
+    given as the sentence range start..end-1.
+    """
+    return ' '.join(lines[start:end])
+
+def parse_parallelism(args):
     """
-    Get a line of text from the given bead and lines.
-    This is similar to Bertalign._get_line method.
+    Remove the --threads N and --workers N options from the list of
+    command line arguments args.
+    Returns (threads, workers).
     """
-    line = ''
-    if len(bead) > 0:
-        line = ' '.join(lines[bead[0]:bead[-1]+1])
-    return line
+    threads = 1
+    if '--threads' in args:
+        # --threads N aligns N volumes at a time. The threads share the one
+        # loaded encoder, whose requests are merged into common batches,
+        # and the DP kernels release the GIL, so the volumes' DPs run in
+        # parallel. Keep Bertalign(parallel=False) in this mode; the
+        # wavefront kernels already use every core on their own.
+        pos = args.index('--threads')
+        threads = int(args[pos + 1])
+        del args[pos:pos + 2]
+    workers = 0
+    if '--workers' in args:
+        # --workers N aligns the volumes in N processes instead, each with
+        # its own encoder and 1/N of the CPUs for torch, BLAS, faiss and
+        # numba. Uses N times the memory of one process.
+        pos = args.index('--workers')
+        workers = int(args[pos + 1])
+        del args[pos:pos + 2]
+    return threads, workers
 
 def main():
     # Get command line arguments for testing a small set
     test_mode = False
     file_numbers = []
     
-    if len(sys.argv) > 1:
-        if sys.argv[1] == '--test':
+    args = sys.argv[1:]
+    threads, workers = parse_parallelism(args)
+
+    if len(args) > 0:
+        if args[0] == '--test':
             test_mode = True
             # Use the file numbers provided as arguments
-            if len(sys.argv) > 2:
-                file_numbers = sys.argv[2:]
+            if len(args) > 1:
+                file_numbers = args[1:]
             else:
                 # Default to first few files if no specific files are provided
                 file_numbers = ['1', '10', '75']
@@ -89,6 +164,7 @@ def main():
     
     print(f"Processing {len(chinese_files)} files...")
     
+    jobs = []
     for chinese_file in sorted(chinese_files):
         # Extract the number from the filename (assuming it's the basename)
         file_number = os.path.splitext(os.path.basename(chinese_file))[0]
@@ -100,10 +176,15 @@ def main():
             # Create output file path
             output_file = os.path.join(output_folder, f"aligned_{file_number}.txt")
             
-            # Align the files
-            align_files(chinese_file, vietnamese_file, output_file)
+            jobs.append((chinese_file, vietnamese_file, output_file))
         else:
             print(f"No matching Vietnamese file found for {chinese_file}")
+    
+    # Align the files
+    if workers > 0 and not service_url:
+        run_in_workers(align_files, jobs, workers, sizes=job_sizes(jobs))
+    else:
+        align_many_files(jobs, threads=threads)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,12 +5,70 @@ Bertalign initialization
 __author__ = "Jason (bfsujason@163.com)"
 __version__ = "1.1.0"
 
-from bertalign.encoder import Encoder
+import os
+import threading
 
 # See other cross-lingual embedding models at
 # https://www.sbert.net/docs/pretrained_models.html
 
 model_name = "LaBSE"
-model = Encoder(model_name)
 
-from bertalign.aligner import Bertalign
\ No newline at end of file
+# Embeddings are cached on disk so that re-aligning unchanged texts
+# needs (almost) no model inference. Set to None to disable the cache.
+cache_dir = os.environ.get("BERTALIGN_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache", "bertalign"))
+
+# Number of encoding worker processes started with the shared encoder
+# (see Encoder.start_pool). 0 encodes in the calling process.
+encode_processes = int(os.environ.get("BERTALIGN_ENCODE_PROCESSES", 0))
+
+_model = None
+_model_lock = threading.Lock()
+
+def get_model(model=None):
+    """
+    Return the encoder shared by this process.
+    The default encoder is only loaded on first use, so importing
+    bertalign (or bertalign.eval / bertalign.utils) stays cheap.
+    It is loaded once even if several threads ask for it together,
+    and can then be shared by Bertalign instances in those threads.
+    Args:
+        model: Encoder. Optional explicit encoder instance. If given,
+               it is returned as is and the shared encoder is untouched.
+    Returns:
+        encoder: Encoder.
+    """
+    global _model
+    if model is not None:
+        return model
+    with _model_lock:
+        if _model is None:
+            from bertalign.encoder import Encoder
+            model = Encoder(model_name, cache_dir=cache_dir)
+            if encode_processes > 0:
+                model.start_pool(encode_processes)
+            _model = model
+    return _model
+
+def set_model(model):
+    """
+    Replace the encoder shared by this process.
+    Args:
+        model: Encoder or None. None drops the current encoder so
+               that the next get_model() call loads it again.
+    """
+    global _model
+    _model = model
+
+def __getattr__(name):
+    # Keep `bertalign.model` and `from bertalign import Bertalign`
+    # working without paying for torch/faiss/numba at import time.
+    if name == 'model':
+        return get_model()
+    if name == 'Bertalign':
+        from bertalign.aligner import Bertalign
+        return Bertalign
+    if name == 'Encoder':
+        from bertalign.encoder import Encoder
+        return Encoder
+    raise AttributeError("module 'bertalign' has no attribute '{}'".format(name))
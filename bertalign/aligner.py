@@ -1,9 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-from bertalign import model
+from bertalign import get_model
+from bertalign.alignment import Alignment
 from bertalign.corelib import *
+from bertalign.encoder import compose_overlaps, compose_spans, overlap_lens
+from bertalign.storage import VectorStore
 from bertalign.utils import *
 
+# The wavefront kernels synchronize once per anti-diagonal, so with
+# parallel=True they only replace the serial kernels on bands at least
+# this many columns wide. A second-pass band, about 2 * win + 1 wide,
+# leaves a handful of cells per anti-diagonal and runs faster serially.
+_PARALLEL_MIN_W = 256
+
 class Bertalign:
     def __init__(self,
                  src,
@@ -15,21 +26,55 @@ class Bertalign:
                  margin=True,
                  len_penalty=True,
                  is_split=False,
+                 overlap_mode='exact',
+                 vec_dtype='float32',
+                 parallel=False,
+                 sparse_first_pass=False,
+                 band_top_k=False,
+                 chunk_size=None,
+                 hierarchical=False,
+                 adaptive_win=False,
+                 min_win=1,
+                 accept_sim=None,
+                 min_run=4,
+                 model=None,
+                 embed=True,
                ):
         
+        model = get_model(model)
         self.max_align = max_align
         self.top_k = top_k
         self.win = win
         self.skip = skip
         self.margin = margin
         self.len_penalty = len_penalty
+        self.overlap_mode = overlap_mode
+        self.parallel = parallel
+        self.sparse_first_pass = sparse_first_pass
+        self.band_top_k = band_top_k
+        self.chunk_size = chunk_size
+        self.hierarchical = hierarchical
+        self.adaptive_win = adaptive_win
+        self.min_win = min_win
+        self.accept_sim = accept_sim
+        self.min_run = min_run
+        self.vec_dtype = vec_dtype
         
         src = clean_text(src)
         tgt = clean_text(tgt)
         src_lang = 'zh'
         tgt_lang = 'vi'
         
-        if is_split:
+        src_para_starts = tgt_para_starts = None
+        if hierarchical:
+            # Lines are joined back into paragraphs (Excel rows, or the
+            # wrapped lines of a PDF paragraph) and split into sentences
+            # one paragraph at a time.
+            if is_split:
+                raise Exception('Hierarchical alignment needs text with one paragraph per line, not split sentences.')
+            src_sents, src_para_starts = self._split_paras(src.splitlines(), src_lang)
+            tgt_sents, tgt_para_starts = self._split_paras(tgt.splitlines(), tgt_lang)
+        elif is_split:
             src_sents = src.splitlines()
             tgt_sents = tgt.splitlines()
         else:
@@ -45,54 +90,627 @@ class Bertalign:
         print("Source language: {}, Number of sentences: {}".format(src_lang, src_num))
         print("Target language: {}, Number of sentences: {}".format(tgt_lang, tgt_num))
 
-        print("Embedding source and target text using {} ...".format(model.model_name))
-        src_vecs, src_lens = model.transform(src_sents, max_align - 1)
-        tgt_vecs, tgt_lens = model.transform(tgt_sents, max_align - 1)
-
-        char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
-
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.src_sents = src_sents
         self.tgt_sents = tgt_sents
+        self.src_para_starts = src_para_starts
+        self.tgt_para_starts = tgt_para_starts
         self.src_num = src_num
         self.tgt_num = tgt_num
+        self.model = model
+        self._plan = None
+        # align_many() embeds a group of aligners together instead.
+        if embed:
+            self.embed()
+
+    @classmethod
+    def align_many(cls, pairs, threads=1, group_size=16, **kwargs):
+        """
+        Align many text pairs with the same options, a group of pairs at
+        a time. The sentences of a group are embedded together in shared
+        batches. Then the first passes of the group run, and the overlap
+        windows they call for are encoded together in shared batches as
+        well. Finally the second passes run. Both passes can run in a
+        thread pool.
+        A pair that fails only costs itself: its error is printed and
+        None is yielded in its place. If encoding a group together fails,
+        its pairs are encoded one by one.
+        Args:
+            pairs: list of (src, tgt) tuples.
+            threads: int. Number of pairs aligned at a time.
+            group_size: int. Number of pairs embedded together. The vectors
+                        of a group are released once it is aligned.
+            kwargs: Bertalign options shared by all pairs.
+        Yields:
+            aligner: Bertalign with its alignment in result, or None, for
+                     each pair in order. The pairs of a group are yielded
+                     as soon as the group is aligned.
+        """
+        kwargs['model'] = get_model(kwargs.get('model'))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for start in range(0, len(pairs), group_size):
+                group = cls._each(lambda pair: cls(pair[0], pair[1], embed=False, **kwargs),
+                                  pairs[start:start + group_size], executor)
+                group = cls._together(cls._embed_many, group, executor)
+                group = cls._each(lambda aligner: aligner._plan_second_pass() or aligner, group, executor)
+                group = cls._together(cls._encode_windows_many, group, executor)
+                group = cls._each(cls._align_and_release, group, executor)
+                for aligner in group:
+                    yield aligner
+
+    @staticmethod
+    def _each(step, items, executor):
+        """
+        Apply step to each item that is not None. Items whose step fails
+        are reported and replaced by None.
+        """
+        def run(item):
+            if item is None:
+                return None
+            try:
+                return step(item)
+            except Exception as e:
+                print("Error aligning a text pair: {}: {}".format(type(e).__name__, e))
+                return None
+        return list(executor.map(run, items))
+
+    @classmethod
+    def _together(cls, step, aligners, executor):
+        """
+        Apply step to the list of aligners that are not None, or to each
+        of them alone if that fails.
+        """
+        live = [aligner for aligner in aligners if aligner is not None]
+        if not live:
+            return aligners
+        try:
+            step(live)
+            return aligners
+        except Exception as e:
+            print("Error encoding {} text pairs together: {}, encoding them one by one ...".format(len(live), e))
+            return cls._each(lambda aligner: step([aligner]) or aligner, aligners, executor)
+
+    def embed(self):
+        """
+        Embed the sentences of an aligner created with embed=False.
+        """
+        self._embed_many([self])
+
+    @staticmethod
+    def _align_and_release(aligner):
+        aligner.align_sents()
+        aligner.release_vecs()
+        return aligner
+
+    @staticmethod
+    def _embed_many(aligners):
+        """
+        Embed the sentences of aligners that share one model in a single
+        transform_many() call.
+        """
+        model = aligners[0].model
+        if len(aligners) == 1:
+            print("Embedding source and target text using {} ...".format(model.model_name))
+        else:
+            print("Embedding {} text pairs using {} ...".format(len(aligners), model.model_name))
+        docs = []
+        for aligner in aligners:
+            docs.extend(aligner._embed_docs())
+        results = model.transform_many(docs)
+        for n, aligner in enumerate(aligners):
+            aligner._set_vecs(results[2 * n], results[2 * n + 1])
+
+    def _embed_docs(self):
+        """
+        Documents to embed for this pair, as taken by Encoder.transform_many().
+        Only single sentences are needed by the first pass. Multi-sentence
+        windows are encoded by prepare_sents() once the second-pass search
+        path tells which of them can actually be scored.
+        """
+        if self.chunk_size or self.hierarchical:
+            # Chunked and hierarchical modes only keep single-sentence vectors for the whole
+            # text; overlap windows are encoded segment by segment.
+            return [(self.src_sents, 1, None), (self.tgt_sents, 1, None)]
+        return [(self.src_sents, self.max_align - 1, self._single_sent_mask(self.max_align - 1, self.src_num)),
+                (self.tgt_sents, self.max_align - 1, self._single_sent_mask(self.max_align - 1, self.tgt_num))]
+
+    def _set_vecs(self, src_result, tgt_result):
+        num_overlaps = self.max_align - 1
+        src_vecs, src_lens = src_result
+        tgt_vecs, tgt_lens = tgt_result
+        if self.chunk_size or self.hierarchical:
+            src_encoded = self._single_sent_mask(1, self.src_num)
+            tgt_encoded = self._single_sent_mask(1, self.tgt_num)
+            src_lens = overlap_lens(yield_overlaps(self.src_sents, num_overlaps), num_overlaps, self.src_num)
+            tgt_lens = overlap_lens(yield_overlaps(self.tgt_sents, num_overlaps), num_overlaps, self.tgt_num)
+        else:
+            src_encoded = self._single_sent_mask(num_overlaps, self.src_num)
+            tgt_encoded = self._single_sent_mask(num_overlaps, self.tgt_num)
+        # Vectors can be kept as float16 or int8 to save memory.
+        self.src_vecs = VectorStore.from_array(src_vecs, dtype=self.vec_dtype)
+        self.tgt_vecs = VectorStore.from_array(tgt_vecs, dtype=self.vec_dtype)
         self.src_lens = src_lens
         self.tgt_lens = tgt_lens
-        self.char_ratio = char_ratio
-        self.src_vecs = src_vecs
-        self.tgt_vecs = tgt_vecs
+        self.char_ratio = np.sum(src_lens[0,]) / np.sum(tgt_lens[0,])
+        self.src_encoded = src_encoded
+        self.tgt_encoded = tgt_encoded
         
+    def prepare_sents(self):
+        """
+        Run the first pass and encode the overlap windows that the second
+        pass will read, so that align_sents() is left with the DPs.
+        Chunked and hierarchical alignment encode their windows segment
+        by segment inside align_sents() instead.
+        """
+        self._plan_second_pass()
+        self._encode_windows_many([self])
+
     def align_sents(self):
+        if self._plan is None:
+            self.prepare_sents()
+        second_alignment = self._second_pass()
+        self._plan = None
+        self._print_search_stats()
+        print("Finished! Successfully aligning {} {} sentences to {} {} sentences\n".format(self.src_num, self.src_lang, self.tgt_num, self.tgt_lang))
+        self.result = second_alignment
+        return second_alignment
+
+    def _plan_second_pass(self):
+        """
+        Run the first pass and keep what the second pass needs in _plan,
+        including the overlap windows it reads (src_mask and tgt_mask).
+        """
+        self.search_stats = dict(first_w=0, first_cells=0, second_w=0, second_cells=0)
+        plan = {}
+        self._plan = plan
+        if self.hierarchical:
+            # Paragraphs, then the sentences of each paragraph pair,
+            # are aligned in align_sents().
+            return
 
         print("Performing first-step alignment ...")
-        D, I = find_top_k_sents(self.src_vecs[0,:], self.tgt_vecs[0,:], k=self.top_k)
         first_alignment_types = get_alignment_types(2) # 0-1, 1-0, 1-1
         first_w, first_path = find_first_search_path(self.src_num, self.tgt_num)
-        first_pointers = first_pass_align(self.src_num, self.tgt_num, first_w, first_path, first_alignment_types, D, I)
-        first_alignment = first_back_track(self.src_num, self.tgt_num, first_pointers, first_path, first_alignment_types)
-        
+        # Hits outside the first-pass search path are never used, so the
+        # kNN search can be limited to the band.
+        D, I = find_top_k_sents(self.src_vecs.dense(0), self.tgt_vecs.dense(0), k=self.top_k,
+                                search_path=first_path if self.band_top_k else None)
+        if self.sparse_first_pass or self.chunk_size:
+            # Only the top-k cells can score, so chain them directly
+            # instead of filling the whole band.
+            first_alignment = sparse_first_pass_align(self.src_num, self.tgt_num, first_path, D, I)
+            self._add_search_stats('first', first_path)
+        else:
+            if self.adaptive_win:
+                # Only top-k cells score in the first pass, so any band that
+                # holds the heaviest top-k chain gives the same path. Follow
+                # the cheap chain with the second-pass windows instead of
+                # the wide diagonal band.
+                chain = sparse_first_pass_align(self.src_num, self.tgt_num, first_path, D, I)
+                first_w, first_path = find_second_search_path(chain, self._search_wins(chain, I),
+                                                              self.src_num, self.tgt_num)
+                first_w = first_w // 2 + 1 # first_pass_align() keeps 2 * w + 1 columns
+            self._add_search_stats('first', first_path)
+            first_pass = self._dp_kernel(first_pass_align, first_pass_align_parallel, 2 * first_w + 1)
+            first_pointers = first_pass(self.src_num, self.tgt_num, first_w, first_path, first_alignment_types, D, I)
+            first_alignment = first_back_track(self.src_num, self.tgt_num, first_pointers, first_path, first_alignment_types)
+        plan.update(first_alignment=first_alignment, D=D, I=I)
+
+        if self.chunk_size:
+            return
+        if self.accept_sim is not None:
+            plan.update(self._plan_gaps(first_alignment, D, I))
+            return
+        second_alignment_types = get_alignment_types(self.max_align)
+        second_w, second_path = find_second_search_path(first_alignment, self._search_wins(first_alignment, I),
+                                                        self.src_num, self.tgt_num)
+        self._add_search_stats('second', second_path)
+        src_mask, tgt_mask = find_second_search_windows(second_path, second_alignment_types,
+                                                        self.src_num, self.tgt_num, self.max_align - 1)
+        plan.update(second_w=second_w, second_path=second_path, src_mask=src_mask, tgt_mask=tgt_mask)
+
+    def _second_pass(self):
+        """
+        Second-pass alignment from the plan of _plan_second_pass(),
+        once its overlap windows are encoded.
+        """
+        plan = self._plan
+        if self.hierarchical:
+            return self._align_hierarchical()
+        if self.chunk_size:
+            return self._align_chunks(plan['first_alignment'], plan['D'], plan['I'])
+        if 'gaps' in plan:
+            return self._join_gaps(plan['gaps'], plan['beads'], encoded=True)
+
         print("Performing second-step alignment ...")
         second_alignment_types = get_alignment_types(self.max_align)
-        second_w, second_path = find_second_search_path(first_alignment, self.win, self.src_num, self.tgt_num)
-        second_pointers = second_pass_align(self.src_vecs, self.tgt_vecs, self.src_lens, self.tgt_lens,
-                                            second_w, second_path, second_alignment_types,
-                                            self.char_ratio, self.skip, margin=self.margin, len_penalty=self.len_penalty)
-        second_alignment = second_back_track(self.src_num, self.tgt_num, second_pointers, second_path, second_alignment_types)
-        
-        print("Finished! Successfully aligning {} {} sentences to {} {} sentences\n".format(self.src_num, self.src_lang, self.tgt_num, self.tgt_lang))
-        self.result = second_alignment
-        return second_alignment
-    
-    def print_sents(self):
-        for bead in (self.result):
-            src_line = self._get_line(bead[0], self.src_sents)
-            tgt_line = self._get_line(bead[1], self.tgt_sents)
-            print(src_line + "\n" + tgt_line + "\n")
+        second_w = plan['second_w']
+        second_path = plan['second_path']
+        second_sims = find_second_pass_similarity(self.src_vecs, self.tgt_vecs, second_w, second_path,
+                                                  second_alignment_types, margin=self.margin)
+        second_scores = find_second_pass_scores(second_sims, self.src_lens, self.tgt_lens,
+                                                second_path, second_alignment_types,
+                                                self.char_ratio, self.skip, len_penalty=self.len_penalty)
+        second_pass = self._dp_kernel(second_pass_align, second_pass_align_parallel, second_w)
+        second_pointers = second_pass(second_scores, second_w, second_path, second_alignment_types)
+        return Alignment(second_back_track(self.src_num, self.tgt_num, second_pointers,
+                                           second_path, second_alignment_types))
+
+    def _align_hierarchical(self):
+        """
+        Align paragraphs first, then align the sentences inside each
+        aligned paragraph pair as an independent segment. Paragraphs
+        are embedded from their sentence vectors, see _para_vecs().
+        """
+        print("Performing paragraph alignment ...")
+        src_num = len(self.src_para_starts) - 1
+        tgt_num = len(self.tgt_para_starts) - 1
+        src_paras = [' '.join(self.src_sents[self.src_para_starts[i]:self.src_para_starts[i+1]])
+                     for i in range(src_num)]
+        tgt_paras = [' '.join(self.tgt_sents[self.tgt_para_starts[j]:self.tgt_para_starts[j+1]])
+                     for j in range(tgt_num)]
+        para_aligner = Bertalign('\n'.join(src_paras), '\n'.join(tgt_paras),
+                                 max_align=self.max_align, top_k=self.top_k, win=self.win,
+                                 skip=self.skip, margin=self.margin, len_penalty=self.len_penalty,
+                                 is_split=True, overlap_mode='composed',
+                                 vec_dtype=self.vec_dtype, parallel=self.parallel,
+                                 adaptive_win=self.adaptive_win, min_win=self.min_win,
+                                 accept_sim=self.accept_sim, min_run=self.min_run, model=self.model,
+                                 embed=False)
+        para_aligner._set_vecs(self._para_vecs(self.src_vecs, self.src_lens, self.src_para_starts, para_aligner.src_sents),
+                               self._para_vecs(self.tgt_vecs, self.tgt_lens, self.tgt_para_starts, para_aligner.tgt_sents))
+        self.para_result = para_aligner.align_sents()
+
+        print("Performing sentence alignment in {} paragraph pairs ...".format(len(self.para_result)))
+        alignment = []
+        for src_para_start, src_para_end, tgt_para_start, tgt_para_end in self.para_result.beads:
+            src_start = self.src_para_starts[src_para_start]
+            src_end = self.src_para_starts[src_para_end]
+            tgt_start = self.tgt_para_starts[tgt_para_start]
+            tgt_end = self.tgt_para_starts[tgt_para_end]
+            if src_start == src_end or tgt_start == tgt_end:
+                # Unmatched paragraphs: every sentence is an insertion or deletion.
+                alignment.append(self._unmatched(src_start, src_end, tgt_start, tgt_end))
+                continue
+            anchors, wins = self._segment_anchors(src_start, src_end, tgt_start, tgt_end)
+            alignment.append(self._align_segment(src_start, src_end, tgt_start, tgt_end, anchors, wins))
+        return Alignment.concatenate(alignment)
+
+    def _para_vecs(self, vecs, lens, para_starts, paras):
+        """
+        Paragraph embeddings, as taken by _set_vecs(), composed from the
+        sentence vectors. Paragraphs and windows of paragraphs are often
+        longer than the model's maximum sequence length, so running the
+        model on them would only embed their beginning.
+        """
+        num_overlaps = self.max_align - 1
+        para_vecs = np.zeros((num_overlaps, len(paras), vecs.shape[2]), dtype=np.float32)
+        para_vecs[0] = compose_spans(vecs.dense(0), lens[0], para_starts)
+        para_lens = overlap_lens(yield_overlaps(paras, num_overlaps), num_overlaps, len(paras))
+        return para_vecs, para_lens
+
+    def _segment_anchors(self, src_start, src_end, tgt_start, tgt_end):
+        """
+        First-pass 1-1 anchors of a segment, relative to the segment,
+        and the second-pass window size around each of them.
+        """
+        src_num = src_end - src_start
+        tgt_num = tgt_end - tgt_start
+        D, I = find_top_k_sents(self.src_vecs.rows(0, src_start, src_end),
+                                self.tgt_vecs.rows(0, tgt_start, tgt_end), k=self.top_k)
+        first_w, first_path = find_first_search_path(src_num, tgt_num)
+        self._add_search_stats('first', first_path)
+        anchors = sparse_first_pass_align(src_num, tgt_num, first_path, D, I)
+        return anchors, self._search_wins(anchors, I)
 
     @staticmethod
-    def _get_line(bead, lines):
-        line = ''
-        if len(bead) > 0:
-            line = ' '.join(lines[bead[0]:bead[-1]+1])
-        return line
+    def _split_paras(lines, lang):
+        sents = []
+        para_starts = [0]
+        for para in join_wrapped_lines(lines, lang):
+            sents.extend(split_sents(para, lang))
+            para_starts.append(len(sents))
+        return sents, para_starts
+
+    def _align_chunks(self, first_alignment, D, I):
+        """
+        Run the second pass on independent segments cut at confident
+        first-pass anchors, and stitch the segment alignments together.
+        """
+        cuts = self._find_cuts(first_alignment, I)
+        wins = np.broadcast_to(self._search_wins(first_alignment, I), (len(first_alignment),))
+        accepted = self._find_accepted(first_alignment, D, I)
+        print("Performing second-step alignment on {} segments ...".format(len(cuts) + 1))
+        alignment = []
+        src_start = tgt_start = 0
+        anchor = 0
+        for src_end, tgt_end in cuts + [(self.src_num, self.tgt_num)]:
+            first_anchor = anchor
+            while anchor < len(first_alignment) and first_alignment[anchor][0] <= src_end:
+                anchor += 1
+            gaps, beads = self._split_at_runs(src_start, src_end, tgt_start, tgt_end,
+                                              first_alignment[first_anchor:anchor],
+                                              wins[first_anchor:anchor], accepted[first_anchor:anchor])
+            alignment.append(self._join_gaps(gaps, beads))
+            src_start, tgt_start = src_end, tgt_end
+        return Alignment.concatenate(alignment)
+
+    def _plan_gaps(self, first_alignment, D, I):
+        """
+        Keep runs of accepted first-pass anchors as final 1-1 beads and
+        plan the second pass on the gaps between them only. The overlap
+        windows of all gaps are encoded together before the gaps are aligned.
+        """
+        wins = np.broadcast_to(self._search_wins(first_alignment, I), (len(first_alignment),))
+        accepted = self._find_accepted(first_alignment, D, I)
+        gaps, beads = self._split_at_runs(0, self.src_num, 0, self.tgt_num, first_alignment, wins, accepted)
+        print("Accepted {} confident 1-1 beads, second-step alignment will run on {} gaps ...".format(
+            len(beads), sum(src_start < src_end and tgt_start < tgt_end
+                            for src_start, src_end, tgt_start, tgt_end, _, _ in gaps)))
+        src_mask = np.zeros_like(self.src_encoded)
+        tgt_mask = np.zeros_like(self.tgt_encoded)
+        for src_start, src_end, tgt_start, tgt_end, anchors, gap_wins in gaps:
+            if src_start == src_end or tgt_start == tgt_end:
+                continue
+            _, _, gap_src_mask, gap_tgt_mask = self._segment_search(src_end - src_start, tgt_end - tgt_start,
+                                                                     anchors, gap_wins)
+            src_mask[:, src_start:src_end] |= gap_src_mask
+            tgt_mask[:, tgt_start:tgt_end] |= gap_tgt_mask
+        return dict(gaps=gaps, beads=beads, src_mask=src_mask, tgt_mask=tgt_mask)
+
+    def _find_accepted(self, first_alignment, D, I):
+        """
+        Mark the confident first-pass anchors whose top-1 similarity
+        reaches accept_sim. They are kept as final 1-1 beads.
+        """
+        if self.accept_sim is None:
+            return np.zeros(len(first_alignment), dtype=bool)
+        confident = find_confident_anchors(first_alignment, I)
+        sims = D[first_alignment[:, 0] - 1, 0]
+        accepted = confident & (sims >= self.accept_sim)
+        # Short runs leave many small gaps, whose second passes cost
+        # more than they save; only keep runs of min_run anchors or more.
+        bounds = np.flatnonzero(np.diff(np.r_[0, accepted.astype(np.int8), 0]))
+        for run_start, run_end in zip(bounds[::2], bounds[1::2]):
+            if run_end - run_start < self.min_run:
+                accepted[run_start:run_end] = False
+        return accepted
+
+    @staticmethod
+    def _split_at_runs(src_start, src_end, tgt_start, tgt_end, anchors, wins, accepted):
+        """
+        Cut a segment at its accepted anchors. An accepted anchor (i, j)
+        becomes the 1-1 bead (i-1, i, j-1, j) and the sentences between
+        two accepted beads form a gap for the second pass.
+        Args:
+            anchors: numpy array. First-pass anchors with document indices.
+            wins: numpy array. Second-pass window size around each anchor.
+            accepted: numpy boolean array. Accepted anchors.
+        Returns:
+            gaps: list of (src_start, src_end, tgt_start, tgt_end, anchors, wins)
+                  tuples, one more than beads. Gap anchors are relative to the gap.
+            beads: list of accepted 1-1 beads.
+        """
+        gaps = []
+        beads = []
+        gap_anchors = []
+        gap_wins = []
+        for (i, j), win, is_accepted in zip(np.asarray(anchors).reshape(-1, 2).tolist(), wins, accepted):
+            if i <= src_start or j <= tgt_start or i > src_end or j > tgt_end:
+                continue
+            if is_accepted:
+                gaps.append((src_start, i - 1, tgt_start, j - 1, gap_anchors, gap_wins))
+                beads.append((i - 1, i, j - 1, j))
+                src_start, tgt_start = i, j
+                gap_anchors = []
+                gap_wins = []
+            else:
+                gap_anchors.append((i - src_start, j - tgt_start))
+                gap_wins.append(win)
+        gaps.append((src_start, src_end, tgt_start, tgt_end, gap_anchors, gap_wins))
+        return gaps, beads
+
+    def _join_gaps(self, gaps, beads, encoded=False):
+        """
+        Align each gap from _split_at_runs() and put the accepted
+        beads back in between.
+        """
+        alignment = []
+        for n, (src_start, src_end, tgt_start, tgt_end, anchors, wins) in enumerate(gaps):
+            if n > 0:
+                alignment.append(Alignment([beads[n - 1]]))
+            if src_start == src_end or tgt_start == tgt_end:
+                alignment.append(self._unmatched(src_start, src_end, tgt_start, tgt_end))
+                continue
+            alignment.append(self._align_segment(src_start, src_end, tgt_start, tgt_end,
+                                                 anchors, np.array(wins, dtype=np.int64), encoded=encoded))
+        return Alignment.concatenate(alignment)
+
+    @staticmethod
+    def _unmatched(src_start, src_end, tgt_start, tgt_end):
+        """
+        Alignment of a segment with no sentences on one side:
+        every sentence is an insertion or deletion.
+        """
+        return Alignment([(i, i + 1, tgt_start, tgt_start) for i in range(src_start, src_end)] +
+                         [(src_end, src_end, j, j + 1) for j in range(tgt_start, tgt_end)])
+
+    def _find_cuts(self, first_alignment, I):
+        """
+        Pick segment boundaries about every chunk_size source sentences.
+        A cut is made right after a 1-1 anchor whose target is the top-1
+        hit of its source and whose neighbours are anchors as well, so
+        that no m-n bead is likely to cross it.
+        Returns:
+            cuts: list of (src_end, tgt_end) tuples.
+        """
+        confident = find_confident_anchors(first_alignment, I)
+        cuts = []
+        src_start = 0
+        for (i, j), is_confident in zip(first_alignment.tolist(), confident):
+            if i - src_start < self.chunk_size or i >= self.src_num or j >= self.tgt_num:
+                continue
+            if not is_confident:
+                continue
+            cuts.append((i, j))
+            src_start = i
+        return cuts
+
+    def _align_segment(self, src_start, src_end, tgt_start, tgt_end, anchors, wins, encoded=False):
+        """
+        Second-pass alignment of src_sents[src_start:src_end] with
+        tgt_sents[tgt_start:tgt_end]. Overlap windows are encoded for
+        the segment only and dropped once it is aligned.
+        Args:
+            anchors: list of 1-1 first-pass beads, relative to the segment.
+            wins: int or numpy array. Second-pass window size around each anchor.
+            encoded: boolean. True if the windows of the segment are
+                     already in src_vecs and tgt_vecs.
+        Returns:
+            alignment: Alignment with document sentence indices.
+        """
+        src_num = src_end - src_start
+        tgt_num = tgt_end - tgt_start
+        second_alignment_types = get_alignment_types(self.max_align)
+        second_w, second_path, src_mask, tgt_mask = self._segment_search(src_num, tgt_num, anchors, wins)
+        self._add_search_stats('second', second_path)
+        if encoded:
+            src_vecs = self.src_vecs.slice(src_start, src_end)
+            tgt_vecs = self.tgt_vecs.slice(tgt_start, tgt_end)
+        else:
+            src_vecs = self._segment_vecs(self.src_sents, self.src_vecs, self.src_lens, src_start, src_end, src_mask)
+            tgt_vecs = self._segment_vecs(self.tgt_sents, self.tgt_vecs, self.tgt_lens, tgt_start, tgt_end, tgt_mask)
+        second_sims = find_second_pass_similarity(src_vecs, tgt_vecs, second_w, second_path,
+                                                  second_alignment_types, margin=self.margin)
+        second_scores = find_second_pass_scores(second_sims,
+                                                np.ascontiguousarray(self.src_lens[:, src_start:src_end]),
+                                                np.ascontiguousarray(self.tgt_lens[:, tgt_start:tgt_end]),
+                                                second_path, second_alignment_types,
+                                                self.char_ratio, self.skip, len_penalty=self.len_penalty)
+        second_pass = self._dp_kernel(second_pass_align, second_pass_align_parallel, second_w)
+        second_pointers = second_pass(second_scores, second_w, second_path, second_alignment_types)
+        alignment = Alignment(second_back_track(src_num, tgt_num, second_pointers,
+                                                second_path, second_alignment_types))
+        return alignment.shift(src_start, tgt_start)
+
+    def _segment_search(self, src_num, tgt_num, anchors, wins):
+        """
+        Second-pass search path of a segment and the overlap windows it reads.
+        """
+        if len(anchors) == 0:
+            wins = self.win
+        second_w, second_path = find_second_search_path(anchors, wins, src_num, tgt_num)
+        src_mask, tgt_mask = find_second_search_windows(second_path, get_alignment_types(self.max_align),
+                                                        src_num, tgt_num, self.max_align - 1)
+        return second_w, second_path, src_mask, tgt_mask
+
+    def _search_wins(self, first_alignment, I):
+        """
+        Window size around each first-pass anchor. In adaptive mode the
+        band is narrowed to min_win around confident anchors and kept at
+        win around the others and across the gaps between anchors.
+        Without anchors the whole band is kept at win.
+        """
+        if not self.adaptive_win or len(first_alignment) == 0:
+            return self.win
+        return np.where(find_confident_anchors(first_alignment, I), self.min_win, self.win)
+
+    def _dp_kernel(self, serial, parallel, width):
+        """
+        The wavefront kernel for a band of the given width if parallel
+        is set and the band is wide enough, otherwise the serial one.
+        Both give the same pointers.
+        """
+        if self.parallel and width >= _PARALLEL_MIN_W:
+            return parallel
+        return serial
+
+    def _add_search_stats(self, stage, search_path):
+        width = int(np.max(search_path[:, 1] - search_path[:, 0])) + 1
+        self.search_stats[stage + '_w'] = max(self.search_stats[stage + '_w'], width)
+        self.search_stats[stage + '_cells'] += int(np.sum(search_path[:, 1] - search_path[:, 0] + 1))
+
+    def _print_search_stats(self):
+        print("Search bands: first pass {first_cells} cells (width {first_w}), "
+              "second pass {second_cells} cells (width {second_w})".format(**self.search_stats))
+
+    def _segment_vecs(self, sents, vecs, lens, start, end, mask):
+        """
+        Build the overlap embeddings of sents[start:end] selected by mask,
+        reusing the single-sentence vectors of the whole text.
+        """
+        num_overlaps = self.max_align - 1
+        sent_vecs = vecs.rows(0, start, end)
+        if self.overlap_mode == 'composed':
+            segment_vecs = compose_overlaps(sent_vecs, lens[0, start:end], num_overlaps)
+        else:
+            mask = mask.copy()
+            mask[0] = False
+            segment_vecs, _ = self.model.transform(sents[start:end], num_overlaps, mask=mask)
+            segment_vecs[0] = sent_vecs
+        mask = mask.copy()
+        mask[0] = True
+        store = VectorStore(num_overlaps, end - start, sent_vecs.shape[1], dtype=self.vec_dtype)
+        store.set(mask, segment_vecs)
+        return store
+
+    @staticmethod
+    def _encode_windows_many(aligners):
+        """
+        Encode the overlap windows planned by _plan_second_pass() that
+        have not been encoded yet, for aligners that share one model,
+        in a single transform_many() call.
+        """
+        docs = []
+        owners = []
+        for aligner in aligners:
+            plan = aligner._plan
+            if plan.get('src_mask') is None:
+                continue
+            src_mask = plan['src_mask'] & ~aligner.src_encoded
+            tgt_mask = plan['tgt_mask'] & ~aligner.tgt_encoded
+            num_overlaps = aligner.max_align - 1
+            if aligner.overlap_mode == 'composed':
+                # Build the windows from the single-sentence vectors we already have.
+                src_vecs = compose_overlaps(aligner.src_vecs.dense(0), aligner.src_lens[0], num_overlaps)
+                tgt_vecs = compose_overlaps(aligner.tgt_vecs.dense(0), aligner.tgt_lens[0], num_overlaps)
+                aligner._set_windows(src_mask, src_vecs, tgt_mask, tgt_vecs)
+                continue
+            docs.extend([(aligner.src_sents, num_overlaps, src_mask), (aligner.tgt_sents, num_overlaps, tgt_mask)])
+            owners.append((aligner, src_mask, tgt_mask))
+        if not owners:
+            return
+        print("Embedding {} source and {} target overlap windows ...".format(
+            sum(src_mask.sum() for _, src_mask, _ in owners), sum(tgt_mask.sum() for _, _, tgt_mask in owners)))
+        results = owners[0][0].model.transform_many(docs)
+        for n, (aligner, src_mask, tgt_mask) in enumerate(owners):
+            aligner._set_windows(src_mask, results[2 * n][0], tgt_mask, results[2 * n + 1][0])
+
+    def _set_windows(self, src_mask, src_vecs, tgt_mask, tgt_vecs):
+        self.src_vecs.set(src_mask, src_vecs)
+        self.tgt_vecs.set(tgt_mask, tgt_vecs)
+        self.src_encoded |= src_mask
+        self.tgt_encoded |= tgt_mask
+
+    def release_vecs(self):
+        """
+        Drop the sentence embeddings once alignment is done.
+        The sentences and the alignment result are kept.
+        """
+        self.src_vecs = None
+        self.tgt_vecs = None
+        self.src_encoded = None
+        self.tgt_encoded = None
+
+    @staticmethod
+    def _single_sent_mask(num_overlaps, num_sents):
+        mask = np.zeros((num_overlaps, num_sents), dtype=bool)
+        mask[0] = True
+        return mask
+
+    def print_sents(self):
+        for src_start, src_end, tgt_start, tgt_end in self.result.beads:
+            src_line = ' '.join(self.src_sents[src_start:src_end])
+            tgt_line = ' '.join(self.tgt_sents[tgt_start:tgt_end])
+            print(src_line + "\n" + tgt_line + "\n")
@@ -0,0 +1,46 @@
+import numpy as np
+
+class Alignment:
+    """
+    Sentence alignment stored as an int32 array with one row per bead:
+    src_start, src_end, tgt_start, tgt_end, with end indices exclusive.
+    Indexing and iteration build beads in the list form
+    ([src indices], [tgt indices]) on demand.
+    Args:
+        beads: numpy array of shape (num_beads, 4).
+    """
+    def __init__(self, beads):
+        self.beads = np.asarray(beads, dtype=np.int32).reshape(-1, 4)
+
+    @classmethod
+    def concatenate(cls, alignments):
+        return cls(np.concatenate([alignment.beads for alignment in alignments] + [np.zeros((0, 4))]))
+
+    def shift(self, src_offset, tgt_offset):
+        """
+        Return a copy with source and target indices moved by the offsets.
+        """
+        return Alignment(self.beads + np.array([src_offset, src_offset, tgt_offset, tgt_offset]))
+
+    def tolist(self):
+        return [self._bead(row) for row in self.beads.tolist()]
+
+    def __len__(self):
+        return self.beads.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._bead(row) for row in self.beads[index].tolist()]
+        return self._bead(self.beads[index].tolist())
+
+    def __iter__(self):
+        for row in self.beads.tolist():
+            yield self._bead(row)
+
+    def __repr__(self):
+        return 'Alignment({} beads)'.format(len(self))
+
+    @staticmethod
+    def _bead(row):
+        src_start, src_end, tgt_start, tgt_end = row
+        return list(range(src_start, src_end)), list(range(tgt_start, tgt_end))
@@ -0,0 +1,154 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed store of sentence embeddings.
+    Vectors are kept in a memory-mapped float32 file and looked up through
+    a small sqlite index keyed by (model name, normalized text). When the
+    store reaches max_bytes, the least recently used vectors are evicted.
+    One instance can be shared by several threads, and the cache
+    directory by several processes; lookups and inserts are serialized.
+    Args:
+        cache_dir: str. Root directory of the cache.
+        model_name: str. Name of the embedding model.
+        dim: int. Embedding size.
+        max_bytes: int. Maximum size of the vector file.
+    """
+    def __init__(self, cache_dir, model_name, dim, max_bytes=2 * 1024 ** 3):
+        safe_name = re.sub(r'[^\w.-]+', '_', model_name)
+        self.path = os.path.join(cache_dir, safe_name)
+        os.makedirs(self.path, exist_ok=True)
+        self.model_name = model_name
+        self.dim = dim
+        self.capacity = max(1, max_bytes // (dim * 4))
+
+        self._vec_file = os.path.join(self.path, 'vectors.f32')
+        self._db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+                                   timeout=60, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries '
+                         '(key TEXT PRIMARY KEY, slot INTEGER UNIQUE, used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        # Several processes may create the cache at the same time.
+        self._db.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (dim,))
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        if row[0] != dim:
+            raise Exception('Cache at {} holds {}-dim vectors, not {}'.format(self.path, row[0], dim))
+        self._db.commit()
+
+        self._rows = 0
+        self._vecs = None
+        self._lock = threading.Lock()
+
+    def key(self, text):
+        text = unicodedata.normalize('NFC', text)
+        text = ' '.join(text.split())
+        return hashlib.sha1('{}\0{}'.format(self.model_name, text).encode('utf-8')).hexdigest()
+
+    def get(self, texts):
+        """
+        Look up the embeddings of texts.
+        Args:
+            texts: list of str.
+        Returns:
+            vecs: numpy array of shape (len(texts), dim). Rows of misses are zero.
+            found: numpy boolean array of shape (len(texts),).
+        """
+        keys = [self.key(text) for text in texts]
+        with self._lock:
+            return self._get(keys)
+
+    def _get(self, keys):
+        with self._db:
+            # Another process may evict a slot and overwrite its vector
+            # between the lookup and the read, so hold the write lock
+            # across both, as _put() does.
+            self._db.execute('BEGIN IMMEDIATE')
+            slots = {}
+            for chunk in _chunks(list(set(keys)), 500):
+                query = 'SELECT key, slot FROM entries WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+                slots.update(self._db.execute(query, chunk).fetchall())
+
+            vecs = np.zeros((len(keys), self.dim), dtype=np.float32)
+            found = np.array([key in slots for key in keys], dtype=bool)
+            if slots:
+                hit_slots = np.array([slots[key] for key in keys if key in slots])
+                self._open(hit_slots.max() + 1)
+                vecs[found] = self._vecs[hit_slots]
+                now = time.time()
+                self._db.executemany('UPDATE entries SET used = ? WHERE key = ?',
+                                     [(now, key) for key in slots])
+        return vecs, found
+
+    def put(self, texts, vecs):
+        """
+        Store the embeddings of texts, evicting the least recently used
+        entries if the cache is full.
+        Args:
+            texts: list of str.
+            vecs: numpy array of shape (len(texts), dim).
+        """
+        new = {}
+        for text, vec in zip(texts, vecs):
+            new[self.key(text)] = vec
+        with self._lock:
+            self._put(new)
+
+    def _put(self, new):
+        now = time.time()
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            for chunk in _chunks(list(new), 500):
+                query = 'SELECT key FROM entries WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+                for (key,) in self._db.execute(query, chunk).fetchall():
+                    del new[key]
+            if not new:
+                return
+            keys = list(new)[-self.capacity:]
+            count = self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            slots = list(range(count, min(self.capacity, count + len(keys))))
+            num_evict = len(keys) - len(slots)
+            if num_evict > 0:
+                evicted = self._db.execute('SELECT key, slot FROM entries ORDER BY used LIMIT ?',
+                                           (num_evict,)).fetchall()
+                self._db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _ in evicted])
+                slots.extend(slot for _, slot in evicted)
+            self._open(max(slots) + 1, grow=True)
+            self._vecs[slots] = np.array([new[key] for key in keys], dtype=np.float32)
+            self._vecs.flush()
+            self._db.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                                 [(key, slot, now) for key, slot in zip(keys, slots)])
+
+    def close(self):
+        with self._lock:
+            self._vecs = None
+            self._db.close()
+
+    def _open(self, min_rows, grow=False):
+        """
+        (Re)map the vector file so that it holds at least min_rows rows.
+        The file grows geometrically up to the cache capacity.
+        """
+        if self._vecs is not None and self._rows >= min_rows:
+            return
+        row_bytes = self.dim * 4
+        rows = os.path.getsize(self._vec_file) // row_bytes if os.path.exists(self._vec_file) else 0
+        if rows < min_rows:
+            if not grow:
+                raise Exception('Cache file {} is truncated'.format(self._vec_file))
+            rows = min(self.capacity, max(min_rows, 2 * rows, 1024))
+            with open(self._vec_file, 'ab') as f:
+                f.truncate(rows * row_bytes)
+        self._vecs = np.memmap(self._vec_file, dtype=np.float32, mode='r+', shape=(rows, self.dim))
+        self._rows = rows
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
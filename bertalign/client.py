@@ -0,0 +1,62 @@
+"""
+Thin client of the alignment service (see bertalign.service). It only
+needs numpy, so scripts that use it start without loading the model
+or the alignment kernels.
+"""
+import json
+import urllib.error
+import urllib.request
+
+from bertalign.alignment import Alignment
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+class RemoteResult:
+    """
+    Result of align_remote(), with the attributes of an aligned
+    Bertalign instance that the pipeline scripts read.
+    """
+    def __init__(self, src_sents, tgt_sents, result):
+        self.src_sents = src_sents
+        self.tgt_sents = tgt_sents
+        self.result = result
+
+def align_remote(src, tgt, url=DEFAULT_URL, timeout=None, priority=0, **params):
+    """
+    Align src and tgt on a running alignment service.
+    Args:
+        src: str. Source text.
+        tgt: str. Target text.
+        url: str. Address of the service.
+        timeout: float. Socket timeout in seconds, None to wait for ever.
+        priority: int. Jobs with a higher priority start first.
+        params: Bertalign options.
+    Returns:
+        result: RemoteResult.
+    """
+    data = json.dumps({'src': src, 'tgt': tgt, 'params': params, 'priority': priority}).encode('utf-8')
+    request = urllib.request.Request(url.rstrip('/') + '/align', data=data,
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        raise Exception('Alignment service error: {}'.format(json.loads(e.read()).get('error', e.reason)))
+
+    src_sents = tgt_sents = None
+    beads = []
+    done = False
+    with response:
+        for line in response:
+            message = json.loads(line)
+            if 'error' in message:
+                raise Exception('Alignment service error: {}'.format(message['error']))
+            if 'src_sents' in message:
+                src_sents = message['src_sents']
+                tgt_sents = message['tgt_sents']
+            elif 'beads' in message:
+                beads.extend(message['beads'])
+            elif message.get('done'):
+                done = True
+    if not done:
+        raise Exception('Alignment service closed the connection before the job was done.')
+    return RemoteResult(src_sents, tgt_sents, Alignment(beads))
@@ -4,54 +4,97 @@ import numpy as np
 import numba as nb
 from sys import platform
 
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
 def second_back_track(i, j, pointers, search_path, a_types):
-    alignment = []
-    while ( 1 ):
+    """
+    Retrieve m-n alignments from the second-pass DP table.
+    Args:
+        i: int. Number of source sentences.
+        j: int. Number of target sentences.
+        pointers: numpy array. Backpointer matrix of second-pass alignment.
+        search_path: numpy array. Second-pass search path.
+        a_types: numpy array. Second-pass alignment types.
+    Returns:
+        beads: numpy int32 array of shape (num_beads, 4) holding
+               src_start, src_end, tgt_start, tgt_end of each bead,
+               with end indices exclusive.
+    """
+    beads = np.empty((i + j, 4), dtype=np.int32)
+    num_beads = 0
+    while i > 0 or j > 0:
         j_offset = j - search_path[i][0]
         a = pointers[i][j_offset]
         s = a_types[a][0]
         t = a_types[a][1]
-        src_range = [i - offset - 1 for offset in range(s)][::-1]
-        tgt_range = [j - offset - 1 for offset in range(t)][::-1]
-        alignment.append((src_range, tgt_range))
+        beads[num_beads, 0] = i - s
+        beads[num_beads, 1] = i
+        beads[num_beads, 2] = j - t
+        beads[num_beads, 3] = j
+        num_beads += 1
 
         i = i-s
         j = j-t
-    
-        if i == 0 and j == 0:
-            return alignment[::-1]
-
-@nb.jit(nopython=True, fastmath=True, cache=True)
-def second_pass_align(src_vecs,
-                      tgt_vecs,
-                      src_lens,
-                      tgt_lens,
-                      w,
-                      search_path,
-                      align_types,
-                      char_ratio,
-                      skip,
-                      margin=False,
-                      len_penalty=False):
+    return beads[:num_beads][::-1].copy()
+
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
+def find_second_pass_scores(sims,
+                            src_lens,
+                            tgt_lens,
+                            search_path,
+                            align_types,
+                            char_ratio,
+                            skip,
+                            len_penalty=False):
     """
-    Perform the second-pass alignment to extract m-n bitext segments.
+    Turn the second-pass similarity table into the score each bead adds
+    to a path, so that the DP itself is a pure max-plus over the table.
+    m-n beads score their similarity, weighted by the length penalty if
+    asked; insertions and deletions score skip. The scores are written
+    over sims, so that only one such table is held at a time.
     Args:
-        src_vecs: numpy array of shape (max_align-1, num_src_sents, embedding_size).
-        tgt_vecs: numpy array of shape (max_align-1, num_tgt_sents, embedding_size).
+        sims: numpy array of shape (num_align_types, num_src_sents+1, w).
+              Similarity scores from find_second_pass_similarity().
         src_lens: numpy array of shape (max_align-1, num_src_sents).
         tgt_lens: numpy array of shape (max_align-1, num_tgt_sents).
-        w: int. Predefined window size for the second-pass alignment.
         search_path: numpy array. Second-pass alignment search path.
         align_types: numpy array. Second-pass alignment types.
         char_ratio: float. Source to target length ratio.
         skip: float. Cost for instertion and deletion.
-        margin: boolean. True if choosing modified cosine similarity score.
+        len_penalty: boolean. True if weighting similarity by length differences.
+    Returns:
+        scores: sims, holding the scores.
+    """
+    for a in range(align_types.shape[0]):
+        a_1 = align_types[a][0]
+        a_2 = align_types[a][1]
+        if a_1 == 0 or a_2 == 0:  # deletion or insertion
+            sims[a] = skip
+            continue
+        if not len_penalty:
+            continue
+        for i in range(a_1, sims.shape[1]):
+            i_start = search_path[i][0]
+            for j in range(max(i_start, a_2), search_path[i][1] + 1):
+                penalty = calculate_length_penalty(src_lens, tgt_lens, i, j,
+                                                   a_1, a_2, char_ratio)
+                sims[a][i][j - i_start] *= penalty
+    return sims
+
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
+def second_pass_align(scores, w, search_path, align_types):
+    """
+    Perform the second-pass alignment to extract m-n bitext segments.
+    Args:
+        scores: numpy array of shape (num_align_types, num_src_sents+1, w).
+                Bead scores from find_second_pass_scores().
+        w: int. Predefined window size for the second-pass alignment.
+        search_path: numpy array. Second-pass alignment search path.
+        align_types: numpy array. Second-pass alignment types.
     Returns:
         pointers: numpy array recording best alignments for each DP cell.
     """
     # Intialize cost and backpointer matrix
-    src_len = src_vecs.shape[1]
-    tgt_len = tgt_vecs.shape[1]
+    src_len = search_path.shape[0] - 1
     cost = np.zeros((src_len + 1, w), dtype=nb.float32)
     pointers = np.zeros((src_len + 1, w), dtype=nb.uint8)
   
@@ -61,108 +104,81 @@ def second_pass_align(src_vecs,
         for j in range(i_start, i_end + 1):
             if i + j == 0:
                 continue
-            best_score = -np.inf
-            best_a = -1
-            for a in range(align_types.shape[0]):
-                a_1 = align_types[a][0]
-                a_2 = align_types[a][1]
-                prev_i = i - a_1
-                prev_j = j - a_2
-
-                if prev_i < 0 or prev_j < 0 :  # no previous cell in DP table 
-                    continue
-                prev_i_start = search_path[prev_i][0]
-                prev_i_end =  search_path[prev_i][1]
-                if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
-                    continue
-                prev_j_offset = prev_j - prev_i_start
-                score = cost[prev_i][prev_j_offset]
-
-                if a_1 == 0 or a_2 == 0:  # deletion or insertion
-                    cur_score = skip
-                else:
-                    cur_score = calculate_similarity_score(src_vecs,
-                                                           tgt_vecs,
-                                                           i, j, a_1, a_2, 
-                                                           src_len, tgt_len,
-                                                           margin=margin)
-                    if len_penalty:
-                        penalty = calculate_length_penalty(src_lens, tgt_lens, i, j,
-                                                           a_1, a_2, char_ratio)
-                        cur_score *= penalty
-        
-                score += cur_score
-                if score > best_score:
-                    best_score = score
-                    best_a = a
-            
-            # Update cell(i, j) with the best score
-            # and rescord the trace history.
-            j_offset = j - i_start
-            cost[i][j_offset] = best_score
-            pointers[i][j_offset] = best_a
+            _second_pass_cell(i, j, cost, pointers, scores, search_path, align_types)
       
     return pointers
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
-def calculate_similarity_score(src_vecs,
-                               tgt_vecs,
-                               src_idx,
-                               tgt_idx,
-                               src_overlap,
-                               tgt_overlap,
-                               src_len,
-                               tgt_len,
-                               margin=False):
-  
+@nb.jit(nopython=True, fastmath=True, parallel=True, cache=True, nogil=True)
+def second_pass_align_parallel(scores, w, search_path, align_types):
     """
-    Calulate the semantics-based similarity score of bitext segment.
-    """
-    src_v = src_vecs[src_overlap - 1, src_idx - 1, :]
-    tgt_v = tgt_vecs[tgt_overlap - 1, tgt_idx - 1, :]
-    similarity = nb_dot(src_v, tgt_v)
-    if margin:
-        tgt_neighbor_ave_sim = calculate_neighbor_similarity(src_v, 
-                                                             tgt_overlap,
-                                                             tgt_idx,
-                                                             tgt_len,
-                                                             tgt_vecs)
-    
-        src_neighbor_ave_sim = calculate_neighbor_similarity(tgt_v,
-                                                             src_overlap,
-                                                             src_idx,
-                                                             src_len,
-                                                             src_vecs)
-    
-        neighbor_ave_sim = (tgt_neighbor_ave_sim + src_neighbor_ave_sim) / 2
-        similarity -= neighbor_ave_sim
+    Same as second_pass_align(), but the cells of each anti-diagonal
+    of the DP table, which only depend on earlier anti-diagonals,
+    are filled in parallel. Returns the same pointers.
+    """
+    src_len = search_path.shape[0] - 1
+    tgt_len = search_path[src_len][1]
+    cost = np.zeros((src_len + 1, w), dtype=nb.float32)
+    pointers = np.zeros((src_len + 1, w), dtype=nb.uint8)
 
-    return similarity
+    first_row = 0
+    last_row = 0
+    for d in range(1, src_len + tgt_len + 1):
+        first_row, last_row = _diagonal_rows(d, first_row, last_row, src_len, search_path)
+        for k in nb.prange(last_row - first_row + 1):
+            i = first_row + k
+            j = d - i
+            if j < search_path[i][0] or j > search_path[i][1]:
+                continue
+            _second_pass_cell(i, j, cost, pointers, scores, search_path, align_types)
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
-def calculate_neighbor_similarity(vec, overlap, sent_idx, sent_len, db):
-    left_idx = sent_idx - overlap
-    right_idx = sent_idx + 1
-    
-    if right_idx <= sent_len:
-        right_embed = db[0, right_idx - 1, :]
-        neighbor_right_sim = nb_dot(vec, right_embed)
-    else:
-        neighbor_right_sim = 0
- 
-    if left_idx > 0:
-        left_embed = db[0, left_idx - 1, :]
-        neighbor_left_sim = nb_dot(vec, left_embed)
-    else:
-        neighbor_left_sim = 0
-    
-    neighbor_ave_sim = neighbor_left_sim + neighbor_right_sim
-    if neighbor_right_sim and neighbor_left_sim:
-        neighbor_ave_sim /= 2
+    return pointers
+
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
+def _second_pass_cell(i, j, cost, pointers, scores, search_path, align_types):
+    """
+    Fill cell (i, j) of the second-pass cost and backpointer matrix.
+    """
+    i_start = search_path[i][0]
+    best_score = -np.inf
+    best_a = -1
+    for a in range(align_types.shape[0]):
+        a_1 = align_types[a][0]
+        a_2 = align_types[a][1]
+        prev_i = i - a_1
+        prev_j = j - a_2
+
+        if prev_i < 0 or prev_j < 0 :  # no previous cell in DP table 
+            continue
+        prev_i_start = search_path[prev_i][0]
+        prev_i_end =  search_path[prev_i][1]
+        if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
+            continue
+        prev_j_offset = prev_j - prev_i_start
+        score = cost[prev_i][prev_j_offset] + scores[a][i][j - i_start]
+        if score > best_score:
+            best_score = score
+            best_a = a
     
-    return neighbor_ave_sim
+    # Update cell(i, j) with the best score
+    # and rescord the trace history.
+    j_offset = j - i_start
+    cost[i][j_offset] = best_score
+    pointers[i][j_offset] = best_a
+
+@nb.jit(nopython=True, cache=True, nogil=True)
+def _diagonal_rows(d, first_row, last_row, src_len, search_path):
+    """
+    Advance the range of rows whose search path crosses anti-diagonal d
+    (cells with i + j == d). Both ends only move forward because the
+    bounds of the search path never decrease.
+    """
+    while first_row < src_len and first_row + search_path[first_row][1] < d:
+        first_row += 1
+    while last_row < src_len and last_row + 1 + search_path[last_row + 1][0] <= d:
+        last_row += 1
+    return first_row, last_row
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
 def calculate_length_penalty(src_lens,
                              tgt_lens,
                              src_idx,
@@ -191,7 +207,7 @@ def calculate_length_penalty(src_lens,
     length_penalty = np.log2(1 + min_len / max_len)
     return length_penalty
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
 def nb_dot(x, y):
     return np.dot(x,y)
 
@@ -200,8 +216,9 @@ def find_second_search_path(align, w, src_len, tgt_len):
     Convert 1-1 first-pass alignment to the second-round path.
     The indices along X-axis and Y-axis must be consecutive.
     Args:
-        align: list of tuples. First-pass alignment results.
-        w: int. Predefined window size for the second path.
+        align: numpy array or list of tuples. First-pass alignment results.
+        w: int. Predefined window size for the second path. It can also be
+           an array with one window size per bead of align.
         src_len: int. Number of source sentences.
         tgt_len: int. Number of target sentences.
     Returns:
@@ -209,12 +226,19 @@ def find_second_search_path(align, w, src_len, tgt_len):
     """
     # Ajust the first-alignment result
     # so that the last bead is (src_len, tgt_len).
+    align = [(src, tgt) for src, tgt in np.asarray(align, dtype=np.int64).reshape(-1, 2).tolist()]
+    wins = np.broadcast_to(np.asarray(w, dtype=np.int64), (len(align),)).tolist()
+    if not align:
+        align.append((src_len, tgt_len))
+        wins.append(int(np.max(w)))
     last_bead_src = align[-1][0]
     last_bead_tgt = align[-1][1]
     if last_bead_src != src_len:
         if last_bead_tgt == tgt_len:
             align.pop()
+            wins.pop()
         align.append((src_len, tgt_len))
+        wins.append(wins[-1] if wins else int(np.max(w)))
     else:
         if last_bead_tgt != tgt_len:
             align.pop()
@@ -223,22 +247,181 @@ def find_second_search_path(align, w, src_len, tgt_len):
     """
     Find the search path for each row.
     """
-    prev_src, prev_tgt = 0, 0
+    prev_src, prev_tgt, prev_w = 0, 0, wins[0]
     path = []
-    max_w = -np.inf
-    for src, tgt in align:
+    for (src, tgt), win in zip(align, wins):
         # Limit the search path in a rectangle with the width
         # along the Y axis being (upper_bound - lower_bound).
-        lower_bound = max(0, prev_tgt - w)
-        upper_bound = min(tgt_len, tgt + w)
+        lower_bound = max(0, prev_tgt - prev_w)
+        upper_bound = min(tgt_len, tgt + win)
         path.extend([(lower_bound, upper_bound) for id in range(prev_src+1, src+1)])
-        prev_src, prev_tgt = src, tgt
-        width = upper_bound - lower_bound
-        if width > max_w:
-            max_w = width
-    path = [path[0]] + path # add the search path for row 0
-    return max_w + 1, np.array(path)
+        prev_src, prev_tgt, prev_w = src, tgt, win
+    path = np.array([path[0]] + path) # add the search path for row 0
+    # With varying window sizes neighbouring rectangles may step back;
+    # widen them so that both bounds never decrease.
+    path[:, 0] = np.minimum.accumulate(path[::-1, 0])[::-1]
+    path[:, 1] = np.maximum.accumulate(path[:, 1])
+    max_w = np.max(path[:, 1] - path[:, 0])
+    return max_w + 1, path
+
+def find_confident_anchors(align, index):
+    """
+    Mark the first-pass 1-1 beads that sit inside a run of consecutive
+    1-1 beads and whose target is the top-1 hit of their source.
+    Args:
+        align: numpy array. First-pass alignment results.
+        index: numpy array. Index matrix for top-k similar vecs.
+    Returns:
+        confident: numpy boolean array with one entry per bead of align.
+    """
+    align = np.asarray(align, dtype=np.int64).reshape(-1, 2)
+    if len(align) == 0:
+        return np.zeros(0, dtype=bool)
+    top_1 = index[align[:, 0] - 1, 0] == align[:, 1] - 1
+    step = np.all(np.diff(align, axis=0) == 1, axis=1)
+    return top_1 & np.r_[False, step] & np.r_[step, False]
+
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
+def find_second_search_windows(search_path, align_types, src_len, tgt_len, num_overlaps):
+    """
+    Find the overlap windows read by the second-pass alignment.
+    Only segments ending in a DP cell that has a valid previous cell
+    inside the search path are ever scored.
+    Args:
+        search_path: numpy array. Second-pass alignment search path.
+        align_types: numpy array. Second-pass alignment types.
+        src_len: int. Number of source sentences.
+        tgt_len: int. Number of target sentences.
+        num_overlaps: int. Number of overlap layers (max_align - 1).
+    Returns:
+        src_mask: numpy boolean array of shape (num_overlaps, src_len).
+        tgt_mask: numpy boolean array of shape (num_overlaps, tgt_len).
+    """
+    src_mask = np.zeros((num_overlaps, src_len), dtype=np.bool_)
+    tgt_cover = np.zeros((num_overlaps, tgt_len + 1), dtype=np.int64)
+    for i in range(1, src_len + 1):
+        for a in range(align_types.shape[0]):
+            a_1 = align_types[a][0]
+            a_2 = align_types[a][1]
+            prev_i = i - a_1
+            if a_1 == 0 or a_2 == 0 or prev_i < 0:
+                continue
+            # Target positions j in row i whose previous cell
+            # (prev_i, j - a_2) lies inside the search path.
+            j_start = max(search_path[i][0], search_path[prev_i][0] + a_2, a_2)
+            j_end = min(search_path[i][1], search_path[prev_i][1] + a_2)
+            if j_start > j_end:
+                continue
+            src_mask[a_1 - 1, i - 1] = True
+            tgt_cover[a_2 - 1, j_start - 1] += 1
+            tgt_cover[a_2 - 1, j_end] -= 1
+
+    tgt_mask = np.zeros((num_overlaps, tgt_len), dtype=np.bool_)
+    for overlap in range(num_overlaps):
+        count = 0
+        for j in range(tgt_len):
+            count += tgt_cover[overlap, j]
+            tgt_mask[overlap, j] = count > 0
+    return src_mask, tgt_mask
+
+def find_second_pass_similarity(src_vecs,
+                                tgt_vecs,
+                                w,
+                                search_path,
+                                align_types,
+                                margin=False,
+                                block_size=64):
+    """
+    Precompute the semantics-based similarity of every bitext segment
+    scored by the second-pass alignment, so that the DP only has to look
+    scores up. Rows of the DP table are processed in blocks, and all dot
+    products of a block (segment and neighbor similarities alike) come
+    from a few matrix multiplications over the block's search band.
+    Args:
+        src_vecs: storage.VectorStore of shape (max_align-1, num_src_sents, embedding_size).
+        tgt_vecs: storage.VectorStore of shape (max_align-1, num_tgt_sents, embedding_size).
+        w: int. Width of the second-pass cost matrix.
+        search_path: numpy array. Second-pass alignment search path.
+        align_types: numpy array. Second-pass alignment types.
+        margin: boolean. True if choosing modified cosine similarity score.
+        block_size: int. Number of DP rows scored together.
+    Returns:
+        sims: numpy array of shape (num_align_types, num_src_sents+1, w).
+              sims[a, i, j - search_path[i][0]] is the score of the segment
+              of type a ending at cell (i, j); insertions and deletions are 0.
+    """
+    num_overlaps, src_len = src_vecs.shape[:2]
+    tgt_len = tgt_vecs.shape[1]
+    sims = np.zeros((align_types.shape[0], src_len + 1, w), dtype=np.float32)
+    offsets = np.arange(w)
+
+    for block_start in range(1, src_len + 1, block_size):
+        block_end = min(src_len, block_start + block_size - 1)
+        rows = np.arange(block_start, block_end + 1)
+        tgt_idx = search_path[rows, 0][:, None] + offsets[None, :] # target index j of each cell
+        in_path = (tgt_idx <= search_path[rows, 1][:, None]) & (tgt_idx >= 1)
+        if not in_path.any():
+            continue
+        col_start = tgt_idx[in_path].min()
+        col_end = tgt_idx[in_path].max()
+        row_pos = (rows - block_start)[:, None]
+        col_pos = np.clip(tgt_idx, col_start, col_end) - col_start
+
+        if margin:
+            # Single sentences next to any segment of the block.
+            nb_tgt_start = max(0, col_start - num_overlaps - 1)
+            nb_tgt_vecs = tgt_vecs.rows(0, nb_tgt_start, min(tgt_len, col_end + 1))
+            nb_src_start = max(0, block_start - num_overlaps - 1)
+            nb_src_vecs = src_vecs.rows(0, nb_src_start, min(src_len, block_end + 1))
+
+        src_block = {}
+        tgt_block = {}
+        for a in range(align_types.shape[0]):
+            a_1 = align_types[a][0]
+            a_2 = align_types[a][1]
+            if a_1 == 0 or a_2 == 0:
+                continue
+            if a_1 not in src_block:
+                src_v = src_vecs.rows(a_1 - 1, block_start - 1, block_end)
+                src_nb = src_v @ nb_tgt_vecs.T if margin else None
+                src_block[a_1] = (src_v, src_nb)
+            if a_2 not in tgt_block:
+                tgt_v = tgt_vecs.rows(a_2 - 1, col_start - 1, col_end)
+                tgt_nb = tgt_v @ nb_src_vecs.T if margin else None
+                tgt_block[a_2] = (tgt_v, tgt_nb)
+            src_v, src_nb = src_block[a_1]
+            tgt_v, tgt_nb = tgt_block[a_2]
+
+            similarity = (src_v @ tgt_v.T)[row_pos, col_pos]
+            if margin:
+                # Neighbors of the target segment, seen from the source segment.
+                right = _gather_neighbor(src_nb, row_pos, tgt_idx - nb_tgt_start, tgt_idx < tgt_len)
+                left = _gather_neighbor(src_nb, row_pos, tgt_idx - a_2 - 1 - nb_tgt_start, tgt_idx - a_2 > 0)
+                tgt_neighbor_ave_sim = _neighbor_average(left, right)
+                # Neighbors of the source segment, seen from the target segment.
+                src_idx = rows[:, None] + np.zeros_like(tgt_idx)
+                right = _gather_neighbor(tgt_nb, col_pos, src_idx - nb_src_start, src_idx < src_len)
+                left = _gather_neighbor(tgt_nb, col_pos, src_idx - a_1 - 1 - nb_src_start, src_idx - a_1 > 0)
+                src_neighbor_ave_sim = _neighbor_average(left, right)
+                similarity -= (tgt_neighbor_ave_sim + src_neighbor_ave_sim) / 2
+
+            sims[a, block_start:block_end + 1] = np.where(in_path, similarity, 0)
+
+    return sims
 
+def _gather_neighbor(sims, pos, neighbor_pos, valid):
+    neighbor_pos = np.clip(neighbor_pos, 0, sims.shape[1] - 1)
+    return np.where(valid, sims[pos, neighbor_pos], 0)
+
+def _neighbor_average(left, right):
+    # Only average when both neighbors contribute; a missing
+    # neighbor (at the text boundary) scores zero.
+    total = left + right
+    both = (left != 0) & (right != 0)
+    total[both] /= 2
+    return total
+
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
 def first_back_track(i, j, pointers, search_path, a_types):
     """
     Retrieve 1-1 alignments from the first-pass DP table.
@@ -249,24 +432,26 @@ def first_back_track(i, j, pointers, search_path, a_types):
         search_path: numpy array. First-pass search path.
         a_types: numpy array. First-pass alignment types.
     Returns:
-        alignment: list of tuples for 1-1 alignments.
+        alignment: numpy array of shape (num_beads, 2) holding the
+                   1-based (i, j) cell of each 1-1 alignment.
     """
-    alignment = []
-    while ( 1 ):
+    alignment = np.empty((min(i, j), 2), dtype=np.int64)
+    num_beads = 0
+    while i > 0 or j > 0:
         j_offset = j - search_path[i][0]
         a = pointers[i][j_offset]
         s = a_types[a][0]
         t = a_types[a][1]
         if a == 2: # best 1-1 alignment
-            alignment.append((i, j))
+            alignment[num_beads, 0] = i
+            alignment[num_beads, 1] = j
+            num_beads += 1
 
         i = i-s
         j = j-t
-    
-        if i == 0 and j == 0: # if reaching the origin
-            return alignment[::-1]
+    return alignment[:num_beads][::-1].copy()
 
-@nb.jit(nopython=True, fastmath=True, cache=True)
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
 def first_pass_align(src_len,
                      tgt_len,
                      w,
@@ -291,8 +476,6 @@ def first_pass_align(src_len,
     # Initialize cost and backpointer matrix.
     cost = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.float32)
     pointers = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.uint8)
-  
-    top_k = index.shape[1]
 
     for i in range(src_len + 1):
         i_start = search_path[i][0]
@@ -300,39 +483,173 @@ def first_pass_align(src_len,
         for j in range(i_start, i_end + 1):
             if i + j == 0: # initialize the origin with zero
                 continue
-            best_score = -np.inf
-            best_a = -1
-            for a in range(align_types.shape[0]):
-                a_1 = align_types[a][0]
-                a_2 = align_types[a][1]
-                prev_i = i - a_1
-                prev_j = j - a_2
-                if prev_i < 0 or prev_j < 0 :  # no previous cell 
-                    continue
-                prev_i_start = search_path[prev_i][0]
-                prev_i_end =  search_path[prev_i][1]
-                if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
-                    continue
-                prev_j_offset = prev_j - prev_i_start
-                score = cost[prev_i][prev_j_offset]
-                
-                # Extract the score for 1-1 bead from faiss.
-                if a_1 > 0 and a_2 > 0:
-                    for k in range(top_k):
-                        if index[i-1][k] == j - 1:
-                            score += dist[i-1][k]
-                if score > best_score:
-                    best_score = score
-                    best_a = a
-            
-            # Update cell(i, j) with the best score
-            # and rescord the trace history.
-            j_offset = j - i_start
-            cost[i][j_offset] = best_score
-            pointers[i][j_offset] = best_a
+            _first_pass_cell(i, j, cost, pointers, search_path, align_types, dist, index)
+
+    return pointers
+
+@nb.jit(nopython=True, fastmath=True, parallel=True, cache=True, nogil=True)
+def first_pass_align_parallel(src_len,
+                              tgt_len,
+                              w,
+                              search_path,
+                              align_types,
+                              dist,
+                              index
+                              ):
+    """
+    Same as first_pass_align(), but the cells of each anti-diagonal
+    of the DP table, which only depend on earlier anti-diagonals,
+    are filled in parallel. Returns the same pointers.
+    """
+    cost = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.float32)
+    pointers = np.zeros((src_len + 1, 2 * w + 1), dtype=nb.uint8)
+
+    first_row = 0
+    last_row = 0
+    for d in range(1, src_len + tgt_len + 1):
+        first_row, last_row = _diagonal_rows(d, first_row, last_row, src_len, search_path)
+        for k in nb.prange(last_row - first_row + 1):
+            i = first_row + k
+            j = d - i
+            if j < search_path[i][0] or j > search_path[i][1]:
+                continue
+            _first_pass_cell(i, j, cost, pointers, search_path, align_types, dist, index)
 
     return pointers
 
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
+def _first_pass_cell(i, j, cost, pointers, search_path, align_types, dist, index):
+    """
+    Fill cell (i, j) of the first-pass cost and backpointer matrix.
+    """
+    top_k = index.shape[1]
+    i_start = search_path[i][0]
+    best_score = -np.inf
+    best_a = -1
+    for a in range(align_types.shape[0]):
+        a_1 = align_types[a][0]
+        a_2 = align_types[a][1]
+        prev_i = i - a_1
+        prev_j = j - a_2
+        if prev_i < 0 or prev_j < 0 :  # no previous cell 
+            continue
+        prev_i_start = search_path[prev_i][0]
+        prev_i_end =  search_path[prev_i][1]
+        if prev_j < prev_i_start or prev_j > prev_i_end: # out of bound of cost matrix
+            continue
+        prev_j_offset = prev_j - prev_i_start
+        score = cost[prev_i][prev_j_offset]
+        
+        # Extract the score for 1-1 bead from faiss.
+        if a_1 > 0 and a_2 > 0:
+            for k in range(top_k):
+                if index[i-1][k] == j - 1:
+                    score += dist[i-1][k]
+        if score > best_score:
+            best_score = score
+            best_a = a
+    
+    # Update cell(i, j) with the best score
+    # and rescord the trace history.
+    j_offset = j - i_start
+    cost[i][j_offset] = best_score
+    pointers[i][j_offset] = best_a
+
+@nb.jit(nopython=True, fastmath=True, cache=True, nogil=True)
+def sparse_first_pass_align(src_len, tgt_len, search_path, dist, index):
+    """
+    Sparse alternative to first_pass_align() + first_back_track().
+    In the first pass only 1-1 beads found by faiss earn a score, and
+    insertions and deletions are free, so the best DP path is the
+    heaviest chain of top-k candidate cells that increases strictly on
+    both axes. It is found with a max Fenwick tree over target indices
+    in O(N*k*log(M)) time and O(N*k + M) memory, instead of filling
+    the (N+1) x (2w+1) table.
+    Args:
+        src_len: int. Number of source sentences.
+        tgt_len: int. Number of target sentences.
+        search_path: numpy array. Search path for the first-pass alignment.
+        dist: numpy array. Distance matrix for top-k similar vecs.
+        index: numpy array. Index matrix for top-k similar vecs.
+    Returns:
+        alignment: numpy array of 1-1 alignments, as from first_back_track().
+    """
+    top_k = index.shape[1]
+    # Candidate cells (i, j) inside the search path with a positive score;
+    # cells with a score <= 0 can never improve a path. Like the dense DP,
+    # a 1-1 step into (i, j) also needs (i-1, j-1) inside the search path.
+    cand_i = np.empty(src_len * top_k, dtype=np.int64)
+    cand_j = np.empty(src_len * top_k, dtype=np.int64)
+    cand_score = np.empty(src_len * top_k, dtype=np.float64)
+    num_cands = 0
+    for i in range(1, src_len + 1):
+        for k in range(top_k):
+            j = index[i-1][k] + 1
+            if j < 1 or dist[i-1][k] <= 0:
+                continue
+            if j < search_path[i][0] or j > search_path[i][1]:
+                continue
+            if j - 1 < search_path[i-1][0] or j - 1 > search_path[i-1][1]:
+                continue
+            cand_i[num_cands] = i
+            cand_j[num_cands] = j
+            cand_score[num_cands] = dist[i-1][k]
+            num_cands += 1
+
+    # Fenwick tree over target indices holding the best chain ending at
+    # or before each index, and the candidate that ends it.
+    tree_score = np.zeros(tgt_len + 1, dtype=np.float64)
+    tree_cand = np.full(tgt_len + 1, -1, dtype=np.int64)
+    chain_score = np.zeros(num_cands, dtype=np.float64)
+    parent = np.full(num_cands, -1, dtype=np.int64)
+
+    row_start = 0
+    while row_start < num_cands:
+        row_end = row_start
+        while row_end < num_cands and cand_i[row_end] == cand_i[row_start]:
+            row_end += 1
+        # Query all candidates of the row before inserting any of them,
+        # so that a chain never takes two cells from the same row.
+        for c in range(row_start, row_end):
+            best = 0.0
+            best_c = -1
+            pos = cand_j[c] - 1
+            while pos > 0:
+                if tree_score[pos] > best:
+                    best = tree_score[pos]
+                    best_c = tree_cand[pos]
+                pos -= pos & (-pos)
+            chain_score[c] = best + cand_score[c]
+            parent[c] = best_c
+        for c in range(row_start, row_end):
+            pos = cand_j[c]
+            while pos <= tgt_len:
+                if chain_score[c] > tree_score[pos]:
+                    tree_score[pos] = chain_score[c]
+                    tree_cand[pos] = c
+                pos += pos & (-pos)
+        row_start = row_end
+
+    best = 0.0
+    best_c = -1
+    for c in range(num_cands):
+        if chain_score[c] > best:
+            best = chain_score[c]
+            best_c = c
+
+    length = 0
+    c = best_c
+    while c >= 0:
+        length += 1
+        c = parent[c]
+    chain = np.empty((length, 2), dtype=np.int64)
+    c = best_c
+    for n in range(length - 1, -1, -1):
+        chain[n, 0] = cand_i[c]
+        chain[n, 1] = cand_j[c]
+        c = parent[c]
+    return chain
+
 def find_first_search_path(src_len,
                            tgt_len,
                            min_win_size = 250,
@@ -377,17 +694,23 @@ def get_alignment_types(max_alignment_size):
                 alignment_types.append([x, y])    
     return np.array(alignment_types)
 
-def find_top_k_sents(src_vecs, tgt_vecs, k=3):
+def find_top_k_sents(src_vecs, tgt_vecs, k=3, search_path=None, block_size=256):
     """
     Find the top_k similar vecs in tgt_vecs for each vec in src_vecs.
     Args:
         src_vecs: numpy array of shape (num_src_sents, embedding_size).
         tgt_vecs: numpy array of shape (num_tgt_sents, embedding_size).
         k: int. Number of most similar target sentences.
+        search_path: numpy array. Optional first-pass search path. If given,
+                     only the targets inside each source row's search range
+                     are scored, see find_band_top_k_sents().
+        block_size: int. Number of source rows scored per matmul with search_path.
     Returns:
         D: numpy array. Similarity score matrix of shape (num_src_sents, k).
         I: numpy array. Target index matrix of shape (num_src_sents, k).
     """
+    if search_path is not None:
+        return find_band_top_k_sents(src_vecs, tgt_vecs, search_path, k=k, block_size=block_size)
     embedding_size = src_vecs.shape[1]
     # if torch.cuda.is_available() and platform == 'linux': # GPU version
     #     res = faiss.StandardGpuResources() 
@@ -400,3 +723,56 @@ def find_top_k_sents(src_vecs, tgt_vecs, k=3):
     index.add(tgt_vecs)
     D, I = index.search(src_vecs, k)
     return D, I
+
+def find_band_top_k_sents(src_vecs, tgt_vecs, search_path, k=3, block_size=256):
+    """
+    Find the top_k similar vecs for each vec in src_vecs among the
+    tgt_vecs inside its row of the first-pass search path.
+    Source rows are scored a block at a time against the diagonal tile
+    of targets their search ranges cover, so the cost grows with
+    N * (2w + block_size) instead of N * M.
+    Every global top_k hit that falls inside the search path is also
+    returned here, with the same score. Rows with fewer than k targets
+    in range are padded with index -1 and score 0.
+    Args:
+        src_vecs: numpy array of shape (num_src_sents, embedding_size).
+        tgt_vecs: numpy array of shape (num_tgt_sents, embedding_size).
+        search_path: numpy array. Search path for the first-pass alignment.
+        k: int. Number of most similar target sentences.
+        block_size: int. Number of source rows scored per matmul.
+    Returns:
+        D: numpy array. Similarity score matrix of shape (num_src_sents, k).
+        I: numpy array. Target index matrix of shape (num_src_sents, k).
+    """
+    src_len = src_vecs.shape[0]
+    tgt_len = tgt_vecs.shape[0]
+    D = np.zeros((src_len, k), dtype=np.float32)
+    I = np.full((src_len, k), -1, dtype=np.int64)
+    # 0-based, end-exclusive target range of each source sentence.
+    row_start = np.maximum(search_path[1:, 0], 1) - 1
+    row_end = np.minimum(search_path[1:, 1], tgt_len)
+    for start in range(0, src_len, block_size):
+        end = min(start + block_size, src_len)
+        tile_start = row_start[start:end].min()
+        tile_end = row_end[start:end].max()
+        if tile_end <= tile_start:
+            continue
+        sims = src_vecs[start:end] @ tgt_vecs[tile_start:tile_end].T
+        cols = np.arange(tile_start, tile_end)
+        in_band = (cols >= row_start[start:end, None]) & (cols < row_end[start:end, None])
+        sims = np.where(in_band, sims, -np.inf)
+
+        top = min(k, sims.shape[1])
+        if top < sims.shape[1]:
+            cand = np.argpartition(-sims, top - 1, axis=1)[:, :top]
+        else:
+            cand = np.broadcast_to(np.arange(top), (end - start, top))
+        cand_sims = np.take_along_axis(sims, cand, axis=1)
+        order = np.argsort(-cand_sims, axis=1, kind='stable')
+        cand = np.take_along_axis(cand, order, axis=1)
+        cand_sims = np.take_along_axis(cand_sims, order, axis=1)
+
+        found = np.isfinite(cand_sims)
+        D[start:end, :top] = np.where(found, cand_sims, 0)
+        I[start:end, :top] = np.where(found, cand + tile_start, -1)
+    return D, I
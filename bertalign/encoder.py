@@ -1,24 +1,337 @@
+import os
+import atexit
+import threading
 import numpy as np
 
-from sentence_transformers import SentenceTransformer
 from bertalign.utils import yield_overlaps
 
 class Encoder:
-    def __init__(self, model_name):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name, cache_dir=None, cache_size=2 * 1024 ** 3, max_tokens=8192,
+                 backend='torch', onnx_dir=None):
+        """
+        Args:
+            model_name: str. Name of the sentence-transformers model.
+            cache_dir: str. Directory of the on-disk embedding cache, None to disable it.
+            cache_size: int. Maximum size of the cache in bytes.
+            max_tokens: int. Token budget of an encoding batch.
+            backend: str. 'torch' runs the SentenceTransformer model, 'onnx' an
+                     int8 quantized ONNX export of it (see bertalign.onnx_backend).
+            onnx_dir: str. Where the ONNX export is stored, defaults to
+                      cache_dir (or ~/.cache/bertalign) + '/onnx'.
+        """
+        if backend == 'onnx' and onnx_dir is None:
+            cache_root = cache_dir or os.path.join(os.path.expanduser("~"), ".cache", "bertalign")
+            onnx_dir = os.path.join(cache_root, 'onnx')
+        self.model = _load_model(model_name, backend, onnx_dir)
         self.model_name = model_name
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.max_tokens = max_tokens
+        self._pool = None
+        # The model (and its tokenizer) is run by one thread at a time.
+        # Threads that ask for embeddings meanwhile queue their texts in
+        # _pending, and the next thread to get the model runs them all.
+        self._model_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.cache = None
+        if cache_dir:
+            from bertalign.cache import EmbeddingCache
+            # Vectors of different backends are not interchangeable.
+            cache_name = model_name if backend == 'torch' else '{}.{}'.format(model_name, backend)
+            self.cache = EmbeddingCache(cache_dir, cache_name, self.dim, max_bytes=cache_size)
 
-    def transform(self, sents, num_overlaps):
-        overlaps = []
-        for line in yield_overlaps(sents, num_overlaps):
-            overlaps.append(line)
+    def start_pool(self, processes=None, threads=None):
+        """
+        Start a persistent pool of encoding processes. Each worker loads
+        the model once; batches are then spread over the workers until
+        stop_pool() is called or the interpreter exits.
+        Args:
+            processes: int. Number of workers, defaults to the CPU count.
+            threads: int. Inference threads per worker, defaults to an even
+                     share of the CPUs.
+        """
+        if self._pool is not None:
+            return
+        import multiprocessing
+        cpus = os.cpu_count() or 1
+        processes = processes or cpus
+        threads = threads or max(1, cpus // processes)
+        print("Starting {} encoding processes with {} threads each ...".format(processes, threads))
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(processes, initializer=_init_worker, initargs=(self.model_name, self.backend, self.onnx_dir, threads))
+        atexit.register(self.stop_pool)
 
-        sent_vecs = self.model.encode(overlaps)
-        embedding_dim = sent_vecs.size // (len(sents) * num_overlaps)
-        sent_vecs.resize(num_overlaps, len(sents), embedding_dim)
+    def stop_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
-        len_vecs = [len(line.encode("utf-8")) for line in overlaps]
-        len_vecs = np.array(len_vecs)
-        len_vecs.resize(num_overlaps, len(sents))
+    def transform(self, sents, num_overlaps, mask=None, overlap_mode='exact'):
+        """
+        Embed all overlap windows of sents.
+        Args:
+            sents: list of str.
+            num_overlaps: int. Maximum number of sentences in a window.
+            mask: numpy boolean array of shape (num_overlaps, num_sents).
+                  Optional. Only the windows set in mask are encoded,
+                  the others are left as zero vectors.
+            overlap_mode: str. 'exact' runs the model on every window.
+                          'composed' only encodes single sentences and builds
+                          the multi-sentence windows with compose_overlaps().
+        Returns:
+            sent_vecs: numpy array of shape (num_overlaps, num_sents, dim).
+            len_vecs: numpy array of shape (num_overlaps, num_sents).
+        """
+        return self.transform_many([(sents, num_overlaps, mask)], overlap_mode=overlap_mode)[0]
 
-        return sent_vecs, len_vecs
\ No newline at end of file
+    def transform_many(self, docs, overlap_mode='exact'):
+        """
+        Same as transform() for several documents at once. The distinct
+        windows of all documents are encoded together, so that short
+        documents share well-filled batches.
+        Args:
+            docs: list of (sents, num_overlaps, mask) tuples.
+            overlap_mode: str. See transform().
+        Returns:
+            results: list of (sent_vecs, len_vecs) tuples, one per document.
+        """
+        if overlap_mode not in ('exact', 'composed'):
+            raise Exception('Unknown overlap mode: {}'.format(overlap_mode))
+        composed = overlap_mode == 'composed'
+
+        # Encode each distinct window once. Padding slots (the first
+        # k windows of layer k) are never read, so they are left as zero
+        # vectors. Blank lines are encoded like any other line, as they
+        # score against the other side; deduplication encodes them once.
+        unique = {}
+        doc_overlaps = []
+        doc_index = []
+        for sents, num_overlaps, mask in docs:
+            overlaps = []
+            for line in yield_overlaps(sents, num_overlaps):
+                overlaps.append(line)
+            num_sents = len(sents)
+            index = np.full(len(overlaps), -1, dtype=np.int64)
+            for overlap in range(1 if composed else num_overlaps):
+                start = overlap * num_sents + min(overlap, num_sents)
+                for i in range(start, (overlap + 1) * num_sents):
+                    line = overlaps[i]
+                    if mask is not None and not composed and not mask[overlap, i - overlap * num_sents]:
+                        continue
+                    index[i] = unique.setdefault(line, len(unique))
+            doc_overlaps.append(overlaps)
+            doc_index.append(index)
+
+        unique_vecs = self.encode(list(unique)) if unique else None
+
+        results = []
+        for (sents, num_overlaps, mask), overlaps, index in zip(docs, doc_overlaps, doc_index):
+            sent_vecs = np.zeros((len(overlaps), self.dim), dtype=np.float32)
+            keep = index >= 0
+            if keep.any():
+                sent_vecs[keep] = unique_vecs[index[keep]]
+            sent_vecs = sent_vecs.reshape(num_overlaps, len(sents), self.dim)
+
+            len_vecs = overlap_lens(overlaps, num_overlaps, len(sents))
+
+            if composed:
+                sent_vecs = compose_overlaps(sent_vecs[0], len_vecs[0], num_overlaps)
+                if mask is not None:
+                    sent_vecs[~mask] = 0
+
+            results.append((sent_vecs, len_vecs))
+        return results
+
+    def encode(self, texts):
+        """
+        Embed texts, only running the model on cache misses.
+        Args:
+            texts: list of str.
+        Returns:
+            vecs: numpy array of shape (len(texts), dim).
+        """
+        if self.cache is None:
+            return self._run_model(texts)
+        vecs, found = self.cache.get(texts)
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            missing_texts = [texts[i] for i in missing]
+            missing_vecs = self._run_model(missing_texts)
+            self.cache.put(missing_texts, missing_vecs)
+            vecs[missing] = missing_vecs
+        return vecs
+
+    def _run_model(self, texts):
+        """
+        Run the model on texts. Safe to call from several threads: the
+        texts of all threads waiting for the model are encoded together,
+        so that concurrent alignments share well-filled batches.
+        """
+        request = _Request(texts)
+        with self._pending_lock:
+            self._pending.append(request)
+        with self._model_lock:
+            with self._pending_lock:
+                requests = self._pending
+                self._pending = []
+            # Our request may already have been run by the previous holder.
+            if requests:
+                self._run_requests(requests)
+        if request.error is not None:
+            raise request.error
+        return request.vecs
+
+    def _run_requests(self, requests):
+        """
+        Encode the texts of several requests in one pass.
+        """
+        unique = {}
+        for request in requests:
+            request.index = np.array([unique.setdefault(text, len(unique)) for text in request.texts],
+                                     dtype=np.int64)
+        try:
+            vecs = self._run_batches(list(unique))
+        except Exception as e:
+            for request in requests:
+                request.error = e
+            return
+        for request in requests:
+            request.vecs = vecs[request.index]
+
+    def _run_batches(self, texts):
+        """
+        Run the model on texts in length-bucketed batches.
+        """
+        vecs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        batches = self._batches(texts)
+        if self._pool is not None:
+            # Batches come longest first, so handing them out one at a
+            # time keeps the workers evenly loaded.
+            results = self._pool.map(_encode_batch, [[texts[i] for i in batch] for batch in batches],
+                                     chunksize=1)
+            for batch, batch_vecs in zip(batches, results):
+                vecs[batch] = batch_vecs
+            return vecs
+        for batch in batches:
+            vecs[batch] = self.model.encode([texts[i] for i in batch], batch_size=len(batch))
+        return vecs
+
+    def _batches(self, texts):
+        """
+        Group texts of similar tokenized length into batches whose padded
+        size (batch size x longest sequence) stays within max_tokens.
+        Returns:
+            batches: list of numpy arrays of indices into texts.
+        """
+        if not texts:
+            return []
+        max_len = self.model.max_seq_length
+        token_ids = self.model.tokenizer(texts, add_special_tokens=True,
+                                         truncation=True, max_length=max_len)['input_ids']
+        lens = np.array([len(ids) for ids in token_ids])
+        order = np.argsort(-lens, kind='stable')
+
+        batches = []
+        start = 0
+        while start < len(order):
+            # Texts are sorted longest first, so the first one sets the padding.
+            size = max(1, self.max_tokens // max(1, lens[order[start]]))
+            batches.append(order[start:start + size])
+            start += size
+        return batches
+
+class _Request:
+    """
+    Texts one thread waits to have encoded by Encoder._run_model().
+    """
+    def __init__(self, texts):
+        self.texts = texts
+        self.index = None
+        self.vecs = None
+        self.error = None
+
+_worker_model = None
+
+def _load_model(model_name, backend, onnx_dir=None, threads=None):
+    if backend == 'torch':
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    elif backend == 'onnx':
+        from bertalign.onnx_backend import OnnxModel
+        return OnnxModel(model_name, onnx_dir, threads=threads)
+    else:
+        raise Exception('Unknown encoder backend: {}'.format(backend))
+
+def _init_worker(model_name, backend, onnx_dir, threads):
+    global _worker_model
+    import torch
+    torch.set_num_threads(threads)
+    _worker_model = _load_model(model_name, backend, onnx_dir, threads=threads)
+
+def _encode_batch(texts):
+    return _worker_model.encode(texts, batch_size=len(texts))
+
+def overlap_lens(overlaps, num_overlaps, num_sents):
+    """
+    Byte lengths of overlap windows as produced by yield_overlaps().
+    Args:
+        overlaps: iterable of str.
+        num_overlaps: int. Maximum number of sentences in a window.
+        num_sents: int. Number of sentences.
+    Returns:
+        len_vecs: numpy array of shape (num_overlaps, num_sents).
+    """
+    len_vecs = [len(line.encode("utf-8")) for line in overlaps]
+    len_vecs = np.array(len_vecs)
+    len_vecs.resize(num_overlaps, num_sents)
+    return len_vecs
+
+def compose_overlaps(sent_vecs, sent_lens, num_overlaps):
+    """
+    Approximate the embeddings of multi-sentence windows from the
+    embeddings of their sentences, without running the model.
+    A window is embedded as the length-weighted sum of its sentence
+    vectors, normalized to unit length.
+    Args:
+        sent_vecs: numpy array of shape (num_sents, dim).
+        sent_lens: numpy array of shape (num_sents,).
+        num_overlaps: int. Maximum number of sentences in a window.
+    Returns:
+        vecs: numpy array of shape (num_overlaps, num_sents, dim).
+              Layer 0 is sent_vecs itself, padding slots are zero.
+    """
+    num_sents, dim = sent_vecs.shape
+    vecs = np.zeros((num_overlaps, num_sents, dim), dtype=np.float32)
+    vecs[0] = sent_vecs
+    weighted = sent_vecs * sent_lens[:, None].astype(np.float32)
+    cum = np.zeros((num_sents + 1, dim), dtype=np.float32)
+    np.cumsum(weighted, axis=0, out=cum[1:])
+    for overlap in range(1, min(num_overlaps, num_sents)):
+        # Window ending at sentence e covers sentences e-overlap..e.
+        window = cum[overlap + 1:] - cum[:num_sents - overlap]
+        norm = np.linalg.norm(window, axis=1, keepdims=True)
+        vecs[overlap, overlap:] = window / np.maximum(norm, 1e-12)
+    return vecs
+
+def compose_spans(sent_vecs, sent_lens, starts):
+    """
+    Approximate the embeddings of consecutive runs of sentences, e.g.
+    paragraphs, the way compose_overlaps() does for windows.
+    Args:
+        sent_vecs: numpy array of shape (num_sents, dim).
+        sent_lens: numpy array of shape (num_sents,).
+        starts: list of int. First sentence of each run, followed by num_sents.
+    Returns:
+        vecs: numpy array of shape (len(starts) - 1, dim).
+    """
+    num_sents, dim = sent_vecs.shape
+    weighted = sent_vecs * sent_lens[:, None].astype(np.float32)
+    cum = np.zeros((num_sents + 1, dim), dtype=np.float32)
+    np.cumsum(weighted, axis=0, out=cum[1:])
+    starts = np.asarray(starts)
+    spans = cum[starts[1:]] - cum[starts[:-1]]
+    norm = np.linalg.norm(spans, axis=1, keepdims=True)
+    return spans / np.maximum(norm, 1e-12)
@@ -0,0 +1,125 @@
+import os
+import re
+import json
+import numpy as np
+
+class OnnxModel:
+    """
+    CPU inference of a sentence-transformers model through onnxruntime.
+    The model is exported to ONNX on first use and, by default, dynamically
+    quantized to int8. It exposes the subset of the SentenceTransformer
+    interface used by Encoder: encode(), tokenizer, max_seq_length and
+    get_sentence_embedding_dimension().
+    Args:
+        model_name: str. Name of the sentence-transformers model.
+        model_dir: str. Directory holding the exported model.
+        quantize: boolean. True to run the int8 quantized model.
+        threads: int. Intra-op threads of the onnxruntime session.
+    """
+    def __init__(self, model_name, model_dir, quantize=True, threads=None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        model_dir = os.path.join(model_dir, re.sub(r'[^\w.-]+', '_', model_name))
+        onnx_file = os.path.join(model_dir, 'model_int8.onnx' if quantize else 'model.onnx')
+        if not os.path.exists(onnx_file):
+            export_onnx(model_name, model_dir, quantize=quantize)
+
+        with open(os.path.join(model_dir, 'bertalign_onnx.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.max_seq_length = meta['max_seq_length']
+        self.dim = meta['dim']
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=32):
+        vecs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            features = self.tokenizer(batch, padding=True, truncation=True,
+                                      max_length=self.max_seq_length, return_tensors='np')
+            feed = {name: features[name].astype(np.int64) for name in self.input_names}
+            vecs[start:start + len(batch)] = self.session.run(None, feed)[0]
+        return vecs
+
+def export_onnx(model_name, model_dir, quantize=True):
+    """
+    Export a sentence-transformers model (transformer, pooling, dense and
+    normalization layers) to a single ONNX graph, and optionally write a
+    dynamically int8-quantized copy next to it.
+    Args:
+        model_name: str. Name of the sentence-transformers model.
+        model_dir: str. Output directory.
+        quantize: boolean. True to also write model_int8.onnx.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    print("Exporting {} to ONNX in {} ...".format(model_name, model_dir))
+    os.makedirs(model_dir, exist_ok=True)
+    model = SentenceTransformer(model_name, device='cpu').eval()
+    input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+
+    class _Wrapper(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            features = {'input_ids': input_ids,
+                        'attention_mask': attention_mask,
+                        'token_type_ids': token_type_ids}
+            return self.model(features)['sentence_embedding']
+
+    sample = model.tokenizer(['Bertalign ONNX export.'], return_tensors='pt')
+    args = tuple(sample[name] for name in input_names)
+    onnx_file = os.path.join(model_dir, 'model.onnx')
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['sentence_embedding'] = {0: 'batch'}
+    with torch.no_grad():
+        torch.onnx.export(_Wrapper(model), args, onnx_file,
+                          input_names=input_names,
+                          output_names=['sentence_embedding'],
+                          dynamic_axes=dynamic_axes,
+                          opset_version=14)
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(onnx_file, os.path.join(model_dir, 'model_int8.onnx'),
+                         weight_type=QuantType.QInt8)
+
+    model.tokenizer.save_pretrained(model_dir)
+    meta = {'model_name': model_name,
+            'dim': model.get_sentence_embedding_dimension(),
+            'max_seq_length': model.max_seq_length}
+    with open(os.path.join(model_dir, 'bertalign_onnx.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+def check_parity(reference, candidate, texts):
+    """
+    Measure how far the embeddings of a candidate encoder drift from
+    those of a reference encoder.
+    Args:
+        reference: Encoder.
+        candidate: Encoder.
+        texts: list of str.
+    Returns:
+        drift: dict with the mean, minimum and 1st percentile cosine
+               similarity between the two encoders' vectors.
+    """
+    ref_vecs = reference.encode(texts)
+    cand_vecs = candidate.encode(texts)
+    norms = np.linalg.norm(ref_vecs, axis=1) * np.linalg.norm(cand_vecs, axis=1)
+    cos = np.sum(ref_vecs * cand_vecs, axis=1) / np.maximum(norms, 1e-12)
+    return dict(mean_cosine=float(np.mean(cos)),
+                min_cosine=float(np.min(cos)),
+                p01_cosine=float(np.percentile(cos, 1)))
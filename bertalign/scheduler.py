@@ -0,0 +1,162 @@
+"""
+Asyncio scheduler for alignment jobs. Jobs wait in a priority queue and
+are started while their estimated memory fits in a budget; the encoding
+and DP work runs in an executor so the event loop stays responsive.
+
+    scheduler = AlignmentScheduler(memory_budget=8 * 1024 ** 3)
+    aligner = await scheduler.submit(src, tgt, priority=10)
+"""
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from bertalign.aligner import Bertalign
+
+_VEC_BYTES = {'float32': 4, 'float16': 2, 'int8': 1}
+
+def estimate_memory(src_num, tgt_num, max_align=5, win=5, dim=768, vec_dtype='float32'):
+    """
+    Rough peak memory of aligning src_num with tgt_num sentences: the
+    overlap embeddings, the first-pass DP tables and the second-pass
+    score tables.
+    Returns:
+        memory: int. Estimated bytes.
+    """
+    num_overlaps = max_align - 1
+    vecs = num_overlaps * (src_num + tgt_num) * dim * _VEC_BYTES[vec_dtype]
+    # float32 cost and uint8 pointers over the first-pass band.
+    first_w = max(250, int(max(src_num, tgt_num) * 0.06))
+    first = (src_num + 1) * (2 * first_w + 1) * 5
+    # Score table of every alignment type (written over the
+    # similarities), plus the float32 cost and uint8 pointers of the DP.
+    num_types = 2 + (max_align - 1) * max_align // 2
+    second_w = 2 * win + max_align
+    second = (src_num + 1) * second_w * (num_types * 4 + 5)
+    return vecs + first + second
+
+class _Job:
+    def __init__(self, priority, memory, admitted):
+        self.priority = priority
+        self.memory = memory
+        self.admitted = admitted
+        self.seq = next(_Job._seq)
+
+    _seq = itertools.count()
+
+    def __lt__(self, other):
+        # Higher priority first, then first come first served.
+        return (-self.priority, self.seq) < (-other.priority, other.seq)
+
+class AlignmentScheduler:
+    """
+    Run alignment jobs by priority under a memory budget.
+    Jobs start in priority order (then submission order) as long as the
+    estimated memory of the running jobs stays within memory_budget. A
+    job larger than the whole budget still runs, but alone. At most
+    max_jobs jobs are in the scheduler at once, queued or running;
+    submit() waits for a free slot, which gives producers backpressure.
+    Args:
+        memory_budget: int. Bytes the running jobs may use together.
+        max_jobs: int. Maximum number of queued and running jobs.
+        executor: concurrent.futures.Executor. Runs sentence splitting,
+                  encoding and the DPs. Defaults to a thread pool, since
+                  the kernels release the GIL and the encoder is shared.
+        history: int. Number of finished jobs kept in stats().
+    """
+    def __init__(self, memory_budget=4 * 1024 ** 3, max_jobs=64, executor=None, history=1000):
+        self.memory_budget = memory_budget
+        self.max_jobs = max_jobs
+        self.executor = executor or ThreadPoolExecutor(max_workers=os.cpu_count())
+        self.memory_in_use = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.finished = deque(maxlen=history)
+        self._queue = []
+        self._slots = asyncio.Semaphore(max_jobs)
+
+    async def submit(self, src, tgt, priority=0, **params):
+        """
+        Align src with tgt once the job gets its turn.
+        Args:
+            src: str. Source text.
+            tgt: str. Target text.
+            priority: int. Jobs with a higher priority start first.
+            params: Bertalign options.
+        Returns:
+            aligner: Bertalign with its alignment in result and its
+                     vectors released.
+        """
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            submitted = time.time()
+            job = started = None
+            ok = False
+            try:
+                # Split the sentences first, so that the memory estimate
+                # comes from the real sentence counts.
+                aligner = await loop.run_in_executor(self.executor,
+                                                     partial(Bertalign, src, tgt, embed=False, **params))
+                memory = estimate_memory(aligner.src_num, aligner.tgt_num, aligner.max_align,
+                                         aligner.win, aligner.model.dim, aligner.vec_dtype)
+                job = _Job(priority, memory, loop.create_future())
+                heapq.heappush(self._queue, job)
+                self._dispatch()
+                await job.admitted
+                started = time.time()
+                await loop.run_in_executor(self.executor, self._run, aligner)
+                ok = True
+            finally:
+                if job is not None and job.admitted.done() and not job.admitted.cancelled():
+                    self.running -= 1
+                    self.memory_in_use -= job.memory
+                    self._dispatch()
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                if started is not None:
+                    self.finished.append(dict(priority=priority, src_num=aligner.src_num,
+                                              tgt_num=aligner.tgt_num, memory=job.memory,
+                                              wait=started - submitted, run=time.time() - started,
+                                              ok=ok))
+        return aligner
+
+    def stats(self):
+        """
+        Queue depth, memory use and the latencies of recent jobs.
+        Returns:
+            stats: dict. 'wait' is the time a job spent before it started
+                   (splitting and queueing), 'run' the time it ran.
+        """
+        return dict(queued=sum(not job.admitted.done() for job in self._queue),
+                    running=self.running,
+                    memory_in_use=self.memory_in_use,
+                    memory_budget=self.memory_budget,
+                    completed=self.completed,
+                    failed=self.failed,
+                    finished=list(self.finished))
+
+    def _dispatch(self):
+        while self._queue:
+            job = self._queue[0]
+            if job.admitted.cancelled():
+                heapq.heappop(self._queue)
+                continue
+            if self.running and self.memory_in_use + job.memory > self.memory_budget:
+                break
+            heapq.heappop(self._queue)
+            self.running += 1
+            self.memory_in_use += job.memory
+            job.admitted.set_result(None)
+
+    @staticmethod
+    def _run(aligner):
+        aligner.embed()
+        aligner.align_sents()
+        aligner.release_vecs()
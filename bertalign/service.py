@@ -0,0 +1,150 @@
+"""
+Resident alignment service. It keeps the encoder loaded and the numba
+kernels compiled, and aligns jobs sent over localhost HTTP, so that a
+re-alignment only pays for the compute.
+
+    python -m bertalign.service --port 8765
+
+A job is POSTed to /align as JSON {"src": ..., "tgt": ..., "params": {...},
+"priority": 0}, where params are Bertalign options. Jobs run through an
+AlignmentScheduler: higher priorities start first, and jobs only run
+together while their estimated memory fits the budget. The reply is streamed as JSON lines:
+{"src_sents": [...], "tgt_sents": [...]}, then one or more
+{"beads": [[src_start, src_end, tgt_start, tgt_end], ...]}, then
+{"done": true}. Failed jobs get {"error": message} instead.
+GET /health tells whether the service is up, GET /stats returns the
+queue depth and the latencies of recent jobs.
+bertalign.client.align_remote() sends a job and reads the reply.
+"""
+import json
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bertalign import get_model
+from bertalign.aligner import Bertalign
+from bertalign.scheduler import AlignmentScheduler
+
+# Number of beads sent per line of a reply.
+BEADS_PER_LINE = 1000
+
+class AlignServer(ThreadingHTTPServer):
+    """
+    HTTP server whose jobs go through an AlignmentScheduler, run on an
+    event loop in its own thread. Concurrent jobs share the warm encoder,
+    which batches their encoding requests together.
+    """
+    def __init__(self, address, scheduler):
+        super().__init__(address, AlignHandler)
+        self.scheduler = scheduler
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def align(self, src, tgt, priority, params):
+        job = self.scheduler.submit(src, tgt, priority=priority, **params)
+        return asyncio.run_coroutine_threadsafe(job, self.loop).result()
+
+    def stats(self):
+        return asyncio.run_coroutine_threadsafe(self._stats(), self.loop).result()
+
+    async def _stats(self):
+        return self.scheduler.stats()
+
+    def server_close(self):
+        super().server_close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class AlignHandler(BaseHTTPRequestHandler):
+    """
+    Waits in the request thread for the scheduler to run the job.
+    """
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok', 'model': get_model().model_name})
+        elif self.path == '/stats':
+            self._reply(200, self.server.stats())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != '/align':
+            self.send_error(404)
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            src, tgt = job['src'], job['tgt']
+            params = job.get('params', {})
+            priority = int(job.get('priority', 0))
+            if 'model' in params or 'embed' in params:
+                raise Exception('The service encoder cannot be changed by a job.')
+        except Exception as e:
+            self._reply(400, {'error': 'Bad alignment job: {}'.format(e)})
+            return
+        try:
+            aligner = self.server.align(src, tgt, priority, params)
+        except Exception as e:
+            self._reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        self._write_line({'src_sents': aligner.src_sents, 'tgt_sents': aligner.tgt_sents})
+        beads = aligner.result.beads.tolist()
+        for start in range(0, len(beads), BEADS_PER_LINE):
+            self._write_line({'beads': beads[start:start + BEADS_PER_LINE]})
+        self._write_line({'done': True})
+
+    def _reply(self, code, message):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        self._write_line(message)
+
+    def _write_line(self, message):
+        self.wfile.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+def serve(host='127.0.0.1', port=8765, warm_up=True, memory_budget=4 * 1024 ** 3, max_jobs=64):
+    """
+    Load the encoder and run the alignment service until interrupted.
+    Args:
+        host: str. Address to listen on. Keep it local; jobs are not authenticated.
+        port: int. Port to listen on.
+        warm_up: boolean. True to align a short text first, so that the
+                 sentence splitters are imported and the kernels loaded
+                 before the first job.
+        memory_budget: int. Bytes the running jobs may use together.
+        max_jobs: int. Maximum number of queued and running jobs.
+    """
+    get_model()
+    if warm_up:
+        print("Warming up ...")
+        src = '天下大亂。諸侯並起。秦滅六國。'
+        tgt = 'Thiên hạ đại loạn. Chư hầu cùng nổi dậy. Nhà Tần diệt sáu nước.'
+        for params in (dict(), dict(sparse_first_pass=True)):
+            Bertalign(src, tgt, **params).align_sents()
+    server = AlignServer((host, port), AlignmentScheduler(memory_budget=memory_budget, max_jobs=max_jobs))
+    print("Bertalign service listening on http://{}:{} ...".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a resident Bertalign alignment service.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on.')
+    parser.add_argument('--no-warm-up', action='store_true', help='Skip the warm-up alignment.')
+    parser.add_argument('--memory-budget', type=float, default=4,
+                        help='Estimated memory in GiB that running jobs may use together.')
+    parser.add_argument('--max-jobs', type=int, default=64, help='Maximum number of queued and running jobs.')
+    args = parser.parse_args()
+    serve(args.host, args.port, warm_up=not args.no_warm_up,
+          memory_budget=int(args.memory_budget * 1024 ** 3), max_jobs=args.max_jobs)
+
+if __name__ == "__main__":
+    main()
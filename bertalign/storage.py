@@ -0,0 +1,85 @@
+import numpy as np
+
+_CODE_TYPES = {'float32': np.float32, 'float16': np.uint16, 'int8': np.uint8}
+
+class VectorStore:
+    """
+    Overlap embeddings of shape (num_overlaps, num_sents, dim) kept as
+    float32, float16 or scalar-quantized int8 with one scale per row.
+    Rows are decoded to float32 a block at a time when they are scored.
+    Args:
+        num_overlaps: int. Number of overlap layers.
+        num_sents: int. Number of sentences.
+        dim: int. Embedding size.
+        dtype: str. 'float32', 'float16' or 'int8'.
+    """
+    def __init__(self, num_overlaps, num_sents, dim, dtype='float32'):
+        if dtype not in _CODE_TYPES:
+            raise Exception('Unsupported vector storage type: {}'.format(dtype))
+        self.dtype = dtype
+        self.codes = np.zeros((num_overlaps, num_sents, dim), dtype=_CODE_TYPES[dtype])
+        self.scales = np.ones((num_overlaps, num_sents), dtype=np.float32)
+
+    @classmethod
+    def from_array(cls, vecs, dtype='float32'):
+        store = cls(vecs.shape[0], vecs.shape[1], vecs.shape[2], dtype=dtype)
+        store.set(np.ones(vecs.shape[:2], dtype=bool), vecs)
+        return store
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def set(self, mask, vecs):
+        """
+        Store the rows of vecs selected by mask.
+        Args:
+            mask: numpy boolean array of shape (num_overlaps, num_sents).
+            vecs: numpy float array of shape (num_overlaps, num_sents, dim).
+        """
+        rows = vecs[mask].astype(np.float32)
+        if self.dtype == 'float32':
+            self.codes[mask] = rows
+        elif self.dtype == 'float16':
+            self.codes[mask] = rows.astype(np.float16).view(np.uint16)
+        else:
+            scales = np.abs(rows).max(axis=1) / 127
+            scales[scales == 0] = 1
+            codes = np.rint(rows / scales[:, None]).astype(np.int8)
+            self.codes[mask] = codes.view(np.uint8)
+            self.scales[mask] = scales
+
+    def slice(self, start, end):
+        """
+        Store of sentences start..end-1 sharing this store's memory.
+        """
+        store = VectorStore.__new__(VectorStore)
+        store.dtype = self.dtype
+        store.codes = self.codes[:, start:end]
+        store.scales = self.scales[:, start:end]
+        return store
+
+    def dense(self, overlap):
+        """
+        Decode one overlap layer to float32.
+        Returns:
+            vecs: numpy array of shape (num_sents, dim).
+        """
+        return self.rows(overlap, 0, self.codes.shape[1])
+
+    def rows(self, overlap, start, end):
+        """
+        Decode rows start..end-1 of one overlap layer to float32.
+        Returns:
+            vecs: numpy array of shape (end - start, dim).
+        """
+        codes = self.codes[overlap, start:end]
+        if self.dtype == 'float32':
+            return codes
+        if self.dtype == 'float16':
+            return codes.view(np.float16).astype(np.float32)
+        return codes.view(np.int8) * self.scales[overlap, start:end, None]
@@ -1,7 +1,8 @@
 import re
-from googletrans import Translator
-from sentence_splitter import SentenceSplitter
-from underthesea import sent_tokenize
+
+# Placeholders used when building overlap windows.
+PAD = 'PAD'
+BLANK_LINE = 'BLANK_LINE'
 
 def clean_text(text):
     clean_text = []
@@ -15,6 +16,7 @@ def clean_text(text):
     return "\n".join(clean_text)
     
 def detect_lang(text):
+    from googletrans import Translator
     translator = Translator(service_urls=[
       'translate.google.com.hk',
     ])
@@ -25,13 +27,42 @@ def detect_lang(text):
         lang = 'zh'
     return lang
 
+# A line ending in one of these, possibly followed by closing quotes or
+# brackets, ends a paragraph in join_wrapped_lines().
+_PARA_END = re.compile('[.!?…。！？]["\'”’»)\\]）」』]*$')
+
+def join_wrapped_lines(lines, lang):
+    """
+    Rebuild paragraphs from layout lines, e.g. the lines of PDF text
+    extraction, by joining each line that does not end a sentence with
+    the next one.
+    Args:
+        lines: list of str.
+        lang: str. Chinese lines are joined without a space.
+    Returns:
+        paras: list of str.
+    """
+    comb = '' if lang == 'zh' else ' '
+    paras = []
+    para = []
+    for line in lines:
+        para.append(line)
+        if _PARA_END.search(line):
+            paras.append(comb.join(para))
+            para = []
+    if para:
+        paras.append(comb.join(para))
+    return paras
+
 def split_sents(text, lang):
     if lang in LANG.SPLITTER:
         if lang == 'zh':
             sents = _split_zh(text)
         elif lang == 'vi':
+            from underthesea import sent_tokenize
             sents = sent_tokenize(text)
         else:
+            from sentence_splitter import SentenceSplitter
             splitter = SentenceSplitter(language=lang)
             sents = splitter.split(text=text) 
             sents = [sent.strip() for sent in sents]
@@ -69,7 +100,7 @@ def yield_overlaps(lines, num_overlaps):
 def _layer(lines, num_overlaps, comb=' '):
     if num_overlaps < 1:
         raise Exception('num_overlaps must be >= 1')
-    out = ['PAD', ] * min(num_overlaps - 1, len(lines))
+    out = [PAD, ] * min(num_overlaps - 1, len(lines))
     for ii in range(len(lines) - num_overlaps + 1):
         out.append(comb.join(lines[ii:ii + num_overlaps]))
     return out
@@ -77,7 +108,7 @@ def _layer(lines, num_overlaps, comb=' '):
 def _preprocess_line(line):
     line = line.strip()
     if len(line) == 0:
-        line = 'BLANK_LINE'
+        line = BLANK_LINE
     return line
     
 class LANG:
@@ -0,0 +1,87 @@
+"""
+Process-pool alignment of many volumes. Each worker process loads the
+shared encoder once and gets an even share of the CPUs, so that torch,
+BLAS/OpenMP, faiss and numba in the different workers do not compete
+for the same cores.
+
+    from bertalign.workers import run_in_workers
+    results = run_in_workers(align_files, jobs, workers=4, sizes=sizes)
+"""
+import os
+
+# Thread counts read by OpenMP, the BLAS libraries and numba when they
+# are loaded. Spawned workers inherit them before importing numpy.
+_THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMBA_NUM_THREADS')
+
+def run_in_workers(func, jobs, workers, sizes=None, threads=None):
+    """
+    Run func(*job) for every job in a pool of worker processes.
+    Jobs are handed out largest first, so that a large volume does not
+    start last and run alone at the end.
+    Args:
+        func: callable. Module-level function, so that it can be sent to
+              the workers. It should return something small, e.g. whether
+              its job succeeded, and write its own output.
+        jobs: list of tuples of arguments of func.
+        workers: int. Number of worker processes.
+        sizes: list of numbers. Optional size of each job, e.g. the bytes
+               of its texts, used to order the jobs.
+        threads: int. Threads per worker for each library, defaults to an
+                 even share of the CPUs.
+    Returns:
+        results: list of the results of func, in the order of jobs.
+    """
+    import multiprocessing
+    cpus = os.cpu_count() or 1
+    threads = threads or max(1, cpus // workers)
+    order = list(range(len(jobs)))
+    if sizes is not None:
+        order.sort(key=lambda n: -sizes[n])
+    print("Starting {} alignment processes with {} threads each ...".format(workers, threads))
+
+    context = multiprocessing.get_context('spawn')
+    saved = {var: os.environ.get(var) for var in _THREAD_VARS}
+    os.environ.update({var: str(threads) for var in _THREAD_VARS})
+    try:
+        pool = context.Pool(workers, initializer=_init_worker, initargs=(threads,))
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    results = [None] * len(jobs)
+    with pool:
+        tasks = [(n, func, jobs[n]) for n in order]
+        for n, result in pool.imap_unordered(_run_job, tasks, chunksize=1):
+            results[n] = result
+    return results
+
+def limit_threads(threads):
+    """
+    Use at most `threads` threads in each of torch, faiss, numba and,
+    where loaded after this call, OpenMP and BLAS.
+    """
+    for var in _THREAD_VARS:
+        os.environ[var] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    import faiss
+    faiss.omp_set_num_threads(threads)
+    import numba
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+def _init_worker(threads):
+    import bertalign
+    # Workers of a pool cannot start their own encoding processes.
+    bertalign.encode_processes = 0
+    limit_threads(threads)
+    # All workers open the same embedding cache directory. The cache
+    # holds the sqlite write lock across each lookup and insert, so a
+    # worker never reads a slot that another one is overwriting.
+    bertalign.get_model()
+
+def _run_job(task):
+    n, func, job = task
+    return n, func(*job)
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import argparse
+from ast import literal_eval
+
+import bertalign
+from bertalign import Bertalign
+from bertalign.eval import read_alignments, score_multiple, log_final_scores
+
+def parse_config(text):
+    """
+    Parse a configuration such as "overlap_mode=composed,win=3"
+    into Bertalign keyword arguments.
+    """
+    config = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        key, value = item.split('=', 1)
+        try:
+            value = literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        config[key.strip()] = value
+    return config
+
+def make_config_encoder(config, encoders):
+    """
+    Give a configuration an encoder without the on-disk embedding cache,
+    so that it does not reuse the embeddings of the configurations run
+    before it and the timings compare. An encoder `backend` option picks
+    the backend of that encoder, since Bertalign itself only takes the
+    encoder object.
+    Args:
+        config: dict. Parsed configuration.
+        encoders: dict. Encoders already loaded, by backend.
+    """
+    config = dict(config)
+    backend = config.pop('backend', 'torch')
+    if backend not in encoders:
+        from bertalign.encoder import Encoder
+        # Keep the ONNX export where the cached encoder would put it.
+        cache_root = bertalign.cache_dir or os.path.join(os.path.expanduser("~"), ".cache", "bertalign")
+        encoders[backend] = Encoder(bertalign.model_name, cache_dir=None, backend=backend,
+                                    onnx_dir=os.path.join(cache_root, 'onnx'))
+    config['model'] = encoders[backend]
+    return config
+
+def read_gold_sents(src_dir, tgt_dir, gold_dir):
+    sents = []
+    for name in sorted(os.listdir(gold_dir)):
+        for folder in (src_dir, tgt_dir):
+            with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                sents.extend(line.strip() for line in f if line.strip())
+    return sents
+
+def align_gold_files(src_dir, tgt_dir, gold_dir, config):
+    """
+    Align every file in gold_dir with the given Bertalign configuration.
+    Source and target files share the gold file name and hold one
+    sentence per line, so that gold indices refer to their lines.
+    """
+    gold_list = []
+    test_list = []
+    for name in sorted(os.listdir(gold_dir)):
+        with open(os.path.join(src_dir, name), 'r', encoding='utf-8') as f:
+            src = f.read()
+        with open(os.path.join(tgt_dir, name), 'r', encoding='utf-8') as f:
+            tgt = f.read()
+        aligner = Bertalign(src, tgt, is_split=True, **config)
+        test_list.append(aligner.align_sents())
+        gold_list.append(read_alignments(os.path.join(gold_dir, name)))
+    return gold_list, test_list
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare Bertalign configurations on gold alignments.')
+    parser.add_argument('--src', required=True, help='Directory of source files, one sentence per line.')
+    parser.add_argument('--tgt', required=True, help='Directory of target files, one sentence per line.')
+    parser.add_argument('--gold', required=True, help='Directory of gold alignment files.')
+    parser.add_argument('--config', action='append', default=[],
+                        help='Bertalign keyword arguments to compare against the defaults, '
+                             'e.g. "overlap_mode=composed". Can be repeated.')
+    args = parser.parse_args()
+
+    encoders = {}
+    configs = [('default', make_config_encoder({}, encoders))]
+    configs += [(text, make_config_encoder(parse_config(text), encoders)) for text in args.config]
+    # Run once untimed, so that compiling the DP kernels and warming up
+    # the model are not charged to the first configuration.
+    align_gold_files(args.src, args.tgt, args.gold, configs[0][1])
+    results = []
+    for name, config in configs:
+        start = time.time()
+        gold_list, test_list = align_gold_files(args.src, args.tgt, args.gold, config)
+        elapsed = time.time() - start
+        res = score_multiple(gold_list=gold_list, test_list=test_list)
+        print('Configuration: {} ({:.1f}s)'.format(name, elapsed), file=sys.stderr)
+        log_final_scores(res)
+        results.append((name, res, elapsed))
+
+    _, base, base_time = results[0]
+    for name, res, elapsed in results[1:]:
+        print('{}: F1 strict {:+.3f}, F1 lax {:+.3f}, time x{:.2f}'.format(
+            name,
+            res['f1_strict'] - base['f1_strict'],
+            res['f1_lax'] - base['f1_lax'],
+            elapsed / base_time if base_time else 0.0), file=sys.stderr)
+
+    # Report how far alternative encoder backends drift from the default one.
+    default_model = configs[0][1]['model']
+    for name, config in configs[1:]:
+        if config['model'] is not default_model:
+            from bertalign.onnx_backend import check_parity
+            sents = read_gold_sents(args.src, args.tgt, args.gold)
+            drift = check_parity(default_model, config['model'], sents)
+            print('{}: cosine to default encoder mean {mean_cosine:.4f}, '
+                  'min {min_cosine:.4f}, 1st percentile {p01_cosine:.4f}'.format(name, **drift),
+                  file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,19 @@ import sys
 import glob
 import yaml
 import re
+import time
+import queue
+import threading
+from functools import partial
 from xml.dom import minidom
 from xml.etree.ElementTree import Element, SubElement, tostring
 import math
 
 # Add Bertalign package to the Python path
 sys.path.append('./bertalign-code/modified_bertalign')
-from bertalign import Bertalign
+from bertalign.workers import run_in_workers
+from align_texts import (service_url, align_files, align_many_files, job_sizes,
+                         read_texts, save_alignment, parse_parallelism)
 
 # Define input and output directories
 chinese_folder = './data_ingestion_chinese/'
@@ -44,52 +50,125 @@ def clean_text(text):
     text = re.sub(r'\s+', ' ', text)
     return text
 
-def align_files(chinese_file, vietnamese_file, output_file):
+# Marks the end of the volumes flowing through a pipeline queue.
+_DONE = object()
+
+def start_stage(name, work, inbox, outbox, busy, workers=1):
     """
-    Align sentences from Chinese and Vietnamese files using Bertalign
-    and save the results to an output file with one Chinese sentence per row.
+    Start `workers` threads that take (job, data) volumes from inbox,
+    apply work to them and put the results in outbox. A volume whose work
+    fails is reported and dropped. The time spent working is added to
+    busy[name].
+    Returns the started threads.
     """
-    try:
-        # Read source and target texts
-        with open(chinese_file, 'r', encoding='utf-8') as f_src:
-            src = f_src.read()
-        
-        with open(vietnamese_file, 'r', encoding='utf-8') as f_tgt:
-            tgt = f_tgt.read()
-        
-        # Create Bertalign object and align sentences
-        print(f"Aligning {os.path.basename(chinese_file)} with {os.path.basename(vietnamese_file)}...")
-        aligner = Bertalign(src, tgt)
-        alignments = aligner.align_sents()
-        
-        # Save aligned sentences to output file
-        with open(output_file, 'w', encoding='utf-8') as f_out:
-            for bead in alignments:
-                src_line = get_line(bead[0], aligner.src_sents)
-                tgt_line = get_line(bead[1], aligner.tgt_sents)
-                
-                if src_line and tgt_line:
-                    # Clean up any newlines within the aligned text to ensure one pair per line
-                    src_line = src_line.replace('\n', ' ').strip()
-                    tgt_line = tgt_line.replace('\n', ' ').strip()
-                    f_out.write(f"{src_line}\t{tgt_line}\n")
-        
-        print(f"Alignment saved to {output_file}")
-        return True
-    
-    except Exception as e:
-        print(f"Error aligning {chinese_file} and {vietnamese_file}: {e}")
-        return False
+    remaining = [workers]
+    lock = threading.Lock()
+    busy[name] = 0.0
+
+    def run():
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # Let the other workers of this stage see the end too.
+                inbox.put(_DONE)
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and outbox is not None:
+                    outbox.put(_DONE)
+                return
+            start = time.time()
+            try:
+                result = work(item)
+            except Exception as e:
+                print(f"Error in the {name} stage for {os.path.basename(item[0][0])}: {e}")
+                continue
+            finally:
+                with lock:
+                    busy[name] += time.time() - start
+            if outbox is not None:
+                outbox.put(result)
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def read_stage(item):
+    """Read the texts of a volume."""
+    job, _ = item
+    return job, read_texts(job[0], job[1])
+
+def split_stage(item):
+    """Split the texts of a volume into sentences, without embedding them."""
+    from bertalign import Bertalign
+    job, (src, tgt) = item
+    print(f"Splitting {os.path.basename(job[0])} and {os.path.basename(job[1])}...")
+    return job, Bertalign(src, tgt, embed=False)
+
+def encode_stage(item):
+    """
+    Embed the sentences of a volume, run its first pass and embed the
+    overlap windows its second pass reads.
+    """
+    item[1].embed()
+    item[1].prepare_sents()
+    return item
 
-def get_line(bead, lines):
+def align_stage(item):
+    """Run the second-pass DPs of a volume and drop its embeddings."""
+    job, aligner = item
+    print(f"Aligning {os.path.basename(job[0])} with {os.path.basename(job[1])}...")
+    aligner.align_sents()
+    aligner.release_vecs()
+    return item
+
+def write_stage(item, metadata, aligned_files):
+    """Save the alignment of a volume and convert it to XML."""
+    job, aligner = item
+    save_alignment(aligner, job[2])
+    convert_aligned_to_xml(job[2], metadata)
+    aligned_files.append(job[2])
+
+def pipeline_files(jobs, metadata, threads=1, queue_size=2):
     """
-    Get a line of text from the given bead and lines.
-    This is similar to Bertalign._get_line method.
+    Align and convert many (chinese_file, vietnamese_file, output_file)
+    jobs as a streaming pipeline: reading, sentence splitting, encoding
+    (with the first pass, which picks the overlap windows to encode),
+    second-pass alignment and TSV/XML writing each run in their own thread(s),
+    connected by queues holding at most queue_size volumes. Volume N+1 is
+    embedded while volume N is aligned and volume N-1 is written, so the
+    wall time approaches that of the slowest stage rather than the sum.
+    The encoder and the DP kernels release the GIL, so the stages overlap.
+    Returns the list of aligned files that were written.
     """
-    line = ''
-    if len(bead) > 0:
-        line = ' '.join(lines[bead[0]:bead[-1]+1])
-    return line
+    aligned_files = []
+    busy = {}
+    start = time.time()
+    stages = [('read', read_stage, 1),
+              ('split', split_stage, 1),
+              ('encode', encode_stage, 1),
+              ('align', align_stage, threads),
+              ('write', partial(write_stage, metadata=metadata, aligned_files=aligned_files), 1)]
+    jobs_queue = queue.Queue(maxsize=queue_size)
+    inbox = jobs_queue
+    workers = []
+    for n, (name, work, num_workers) in enumerate(stages):
+        outbox = queue.Queue(maxsize=queue_size) if n < len(stages) - 1 else None
+        workers.extend(start_stage(name, work, inbox, outbox, busy, workers=num_workers))
+        inbox = outbox
+    
+    # put() blocks while the pipeline is full, so at most a few volumes
+    # are held in memory at a time.
+    for job in jobs:
+        jobs_queue.put((job, None))
+    jobs_queue.put(_DONE)
+    for worker in workers:
+        worker.join()
+    
+    print("Pipeline done in {:.1f}s; busy time per stage: {}".format(
+        time.time() - start, ', '.join(f"{name} {seconds:.1f}s" for name, seconds in busy.items())))
+    return aligned_files
 
 def create_xml_structure(file_number, aligned_data, metadata):
     """Create XML structure for the aligned data with proper IDs."""
@@ -201,12 +280,21 @@ def main():
     test_mode = False
     file_numbers = []
     
-    if len(sys.argv) > 1:
-        if sys.argv[1] == '--test':
+    args = sys.argv[1:]
+    threads, workers = parse_parallelism(args)
+    
+    # --no-pipeline aligns all volumes first and converts them to XML
+    # afterwards, instead of streaming them through pipeline_files().
+    use_pipeline = '--no-pipeline' not in args and not service_url and workers == 0
+    if '--no-pipeline' in args:
+        args.remove('--no-pipeline')
+
+    if len(args) > 0:
+        if args[0] == '--test':
             test_mode = True
             # Use the file numbers provided as arguments
-            if len(sys.argv) > 2:
-                file_numbers = sys.argv[2:]
+            if len(args) > 1:
+                file_numbers = args[1:]
             else:
                 # Default to a few sample files if no specific files are provided
                 file_numbers = ['75', '130']
@@ -229,7 +317,7 @@ def main():
     print(f"Processing {len(chinese_files)} files...")
     
     # Step 2: Process each pair of files
-    aligned_files = []
+    jobs = []
     for chinese_file in sorted(chinese_files):
         # Extract the number from the filename
         file_number = os.path.splitext(os.path.basename(chinese_file))[0]
@@ -241,17 +329,28 @@ def main():
             # Create output file path for aligned text
             aligned_file = os.path.join(aligned_folder, f"aligned_{file_number}.txt")
             
-            # Step 2a: Align the files
-            if align_files(chinese_file, vietnamese_file, aligned_file):
-                aligned_files.append(aligned_file)
+            jobs.append((chinese_file, vietnamese_file, aligned_file))
         else:
             print(f"No matching Vietnamese file found for {chinese_file}")
     
-    print(f"Successfully aligned {len(aligned_files)} file pairs.")
-    
-    # Step 3: Convert aligned files to XML
-    for aligned_file in sorted(aligned_files):
-        convert_aligned_to_xml(aligned_file, metadata)
+    if use_pipeline:
+        # Steps 2a and 3 overlap: each volume is written and converted to
+        # XML as soon as it is aligned, while the next ones are embedded.
+        aligned_files = pipeline_files(jobs, metadata, threads=threads)
+        print(f"Successfully aligned {len(aligned_files)} file pairs.")
+    else:
+        # Step 2a: Align the files
+        if workers > 0 and not service_url:
+            results = run_in_workers(align_files, jobs, workers, sizes=job_sizes(jobs))
+        else:
+            results = align_many_files(jobs, threads=threads)
+        aligned_files = [job[2] for job, ok in zip(jobs, results) if ok]
+        
+        print(f"Successfully aligned {len(aligned_files)} file pairs.")
+        
+        # Step 3: Convert aligned files to XML
+        for aligned_file in sorted(aligned_files):
+            convert_aligned_to_xml(aligned_file, metadata)
     
     print(f"All files processed. Output XML files saved to {xml_folder}")
 
@@ -0,0 +1,56 @@
+import multiprocessing
+import zlib
+
+import numpy as np
+
+from bertalign.cache import EmbeddingCache
+
+DIM = 8
+TEXTS = ['sentence {}'.format(n) for n in range(400)]
+
+def vector(text):
+    return np.random.default_rng(zlib.crc32(text.encode('utf-8'))).normal(size=DIM).astype(np.float32)
+
+def open_cache(cache_dir):
+    # Room for 64 vectors, so that writers keep evicting each other's rows.
+    return EmbeddingCache(cache_dir, 'test-model', DIM, max_bytes=64 * DIM * 4)
+
+def writer(cache_dir, seed, rounds):
+    cache = open_cache(cache_dir)
+    rng = np.random.default_rng(seed)
+    for _ in range(rounds):
+        texts = [TEXTS[n] for n in rng.choice(len(TEXTS), size=40, replace=False)]
+        cache.put(texts, np.array([vector(text) for text in texts]))
+    cache.close()
+
+def reader(cache_dir, seed, rounds, results):
+    cache = open_cache(cache_dir)
+    rng = np.random.default_rng(seed)
+    hits = wrong = 0
+    for _ in range(rounds):
+        texts = [TEXTS[n] for n in rng.choice(len(TEXTS), size=40, replace=False)]
+        vecs, found = cache.get(texts)
+        for text, vec, is_found in zip(texts, vecs, found):
+            if is_found:
+                hits += 1
+                wrong += not np.array_equal(vec, vector(text))
+    cache.close()
+    results.put((hits, wrong))
+
+def test_cache_shared_by_processes(tmp_path):
+    cache_dir = str(tmp_path)
+    open_cache(cache_dir).close()
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=writer, args=(cache_dir, seed, 150)) for seed in range(3)]
+    processes += [context.Process(target=reader, args=(cache_dir, seed, 150, results)) for seed in range(3, 5)]
+    for process in processes:
+        process.start()
+    counts = [results.get(timeout=300) for _ in range(2)]
+    for process in processes:
+        process.join(timeout=300)
+        assert process.exitcode == 0
+    hits = sum(hits for hits, _ in counts)
+    wrong = sum(wrong for _, wrong in counts)
+    assert hits > 0
+    assert wrong == 0
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from bertalign.corelib import (find_first_search_path,
+                               find_second_search_path,
+                               get_alignment_types,
+                               first_pass_align,
+                               first_pass_align_parallel,
+                               first_back_track,
+                               sparse_first_pass_align,
+                               second_pass_align,
+                               second_pass_align_parallel)
+
+def random_top_k(rng, src_len, tgt_len, k=3):
+    index = rng.integers(0, tgt_len, size=(src_len, k))
+    dist = rng.random((src_len, k)).astype(np.float32)
+    return dist, index
+
+def random_chain(rng, src_len, tgt_len):
+    """Random strictly increasing 1-1 chain of (src, tgt) beads."""
+    n = rng.integers(1, min(src_len, tgt_len) + 1)
+    src = np.sort(rng.choice(np.arange(1, src_len + 1), size=n, replace=False))
+    tgt = np.sort(rng.choice(np.arange(1, tgt_len + 1), size=n, replace=False))
+    return np.stack([src, tgt], axis=1)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_first_pass_parallel_matches_serial(seed):
+    rng = np.random.default_rng(seed)
+    src_len, tgt_len = rng.integers(5, 300, size=2)
+    w, path = find_first_search_path(src_len, tgt_len, min_win_size=int(rng.integers(2, 40)))
+    dist, index = random_top_k(rng, src_len, tgt_len)
+    align_types = get_alignment_types(2)
+    serial = first_pass_align(src_len, tgt_len, w, path, align_types, dist, index)
+    parallel = first_pass_align_parallel(src_len, tgt_len, w, path, align_types, dist, index)
+    np.testing.assert_array_equal(serial, parallel)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_second_pass_parallel_matches_serial(seed):
+    rng = np.random.default_rng(seed)
+    src_len, tgt_len = rng.integers(5, 300, size=2)
+    chain = random_chain(rng, src_len, tgt_len)
+    wins = rng.integers(1, 8, size=len(chain))
+    w, path = find_second_search_path(chain, wins, src_len, tgt_len)
+    align_types = get_alignment_types(5)
+    scores = rng.random((len(align_types), src_len + 1, w)).astype(np.float32)
+    serial = second_pass_align(scores, w, path, align_types)
+    parallel = second_pass_align_parallel(scores, w, path, align_types)
+    np.testing.assert_array_equal(serial, parallel)
+
+@pytest.mark.parametrize('seed', range(80))
+def test_sparse_first_pass_matches_dense(seed):
+    rng = np.random.default_rng(seed)
+    src_len, tgt_len = rng.integers(5, 200, size=2)
+    # Narrow bands, but wide enough to stay connected.
+    min_win = int(np.ceil(max(tgt_len / src_len, 1))) + int(rng.integers(0, 8))
+    w, path = find_first_search_path(src_len, tgt_len, min_win_size=min_win, percent=0)
+    # Distinct hits per row, so that no cell scores twice.
+    index = np.array([rng.choice(tgt_len, size=min(3, tgt_len), replace=False) for _ in range(src_len)])
+    dist = rng.random(index.shape).astype(np.float32)
+    align_types = get_alignment_types(2)
+    pointers = first_pass_align(src_len, tgt_len, w, path, align_types, dist, index)
+    dense = first_back_track(src_len, tgt_len, pointers, path, align_types)
+    sparse = sparse_first_pass_align(src_len, tgt_len, path, dist, index)
+    np.testing.assert_array_equal(dense, sparse)